@@ -0,0 +1,129 @@
+"""
+Admission control — caps concurrently running scans behind a bounded wait queue.
+
+Each new scan reserves a ticket. Up to max_active tickets are admitted at once;
+the next max_queue wait in FIFO order, and anything beyond that is rejected so
+the caller can answer 503 + Retry-After instead of slowing every scan down.
+
+Waiting tickets can report their queue position and an estimated wait, based
+on a moving average of how long admitted scans have been taking.
+
+    ticket = admission.reserve()
+    if ticket is None:
+        ...  # queue full
+    while not ticket.admitted:
+        await ticket.wait(timeout=5)
+    ...
+    ticket.release()
+"""
+
+import asyncio
+import math
+import time
+from collections import deque
+
+
+class AdmissionTicket:
+    def __init__(self, control: "AdmissionControl"):
+        self._control = control
+        self._changed = asyncio.Event()
+        self.admitted = False
+        self.admitted_at: float | None = None
+        self.released = False
+
+    @property
+    def position(self) -> int:
+        """1-based place in the wait queue; 0 once admitted."""
+        if self.admitted or self.released:
+            return 0
+        return self._control._queue.index(self) + 1
+
+    @property
+    def estimated_wait(self) -> float:
+        return self._control.estimate_wait(self.position)
+
+    async def wait(self, timeout: float | None = None) -> None:
+        """Return when the ticket is admitted or moves up the queue (or after timeout)."""
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._changed.clear()
+
+    def release(self) -> None:
+        """Give up the slot (admitted) or the queue place (waiting). Idempotent."""
+        self._control._release(self)
+
+
+class AdmissionControl:
+    def __init__(self, max_active: int, max_queue: int, initial_scan_seconds: float = 20.0):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.active = 0
+        self.rejected = 0
+        self.avg_scan_seconds = initial_scan_seconds
+        self._queue: deque[AdmissionTicket] = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    @property
+    def full(self) -> bool:
+        return self.active >= self.max_active and self.queued >= self.max_queue
+
+    def reject(self) -> None:
+        """Count a scan turned away (e.g. checked against full before reserving)."""
+        self.rejected += 1
+
+    def reserve(self) -> AdmissionTicket | None:
+        """A ticket (admitted or queued), or None when the wait queue is full."""
+        if self.full:
+            self.reject()
+            return None
+        ticket = AdmissionTicket(self)
+        self._queue.append(ticket)
+        self._admit_waiting()
+        return ticket
+
+    def estimate_wait(self, position: int) -> float:
+        """Seconds until the ticket at this queue position is likely admitted."""
+        if position <= 0:
+            return 0.0
+        return round(position * self.avg_scan_seconds / self.max_active, 1)
+
+    def retry_after(self) -> int:
+        """Seconds a rejected client should wait before retrying."""
+        return max(1, math.ceil(self.estimate_wait(self.queued + 1)))
+
+    def _admit_waiting(self) -> None:
+        while self.active < self.max_active and self._queue:
+            ticket = self._queue.popleft()
+            ticket.admitted = True
+            ticket.admitted_at = time.monotonic()
+            self.active += 1
+            ticket._changed.set()
+
+    def _release(self, ticket: AdmissionTicket) -> None:
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket.admitted:
+            self.active -= 1
+            elapsed = time.monotonic() - ticket.admitted_at
+            self.avg_scan_seconds = 0.8 * self.avg_scan_seconds + 0.2 * elapsed
+        else:
+            self._queue.remove(ticket)
+        self._admit_waiting()
+        for waiting in self._queue:
+            waiting._changed.set()  # positions moved up
+
+    def snapshot(self) -> dict:
+        return {
+            "max_active": self.max_active,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "avg_scan_seconds": round(self.avg_scan_seconds, 1),
+        }
@@ -0,0 +1,207 @@
+"""
+End-to-end scan benchmark — drives /check-stream and /check against the stub doh.co.il.
+
+Starts bench/stub_doh.py and the API (uvicorn main:app, with UPSTREAM_OVERRIDE
+pointing at the stub and the in-memory scan log), then runs --scans scans at
+each concurrency level. Every scan uses a fresh car number, so nothing is
+served from the result cache. Reports per level:
+
+    p50/p95/p99 scan time   request sent -> done event (or /check response)
+    first result p50/p95    request sent -> first "result" event (/check-stream only)
+    scans/s                 completed scans / wall time
+
+    python bench/bench_scan.py --concurrency 1,5,20 --scans 20 --latency 80
+    python bench/bench_scan.py --app-url http://127.0.0.1:8000   # API already running
+
+The API reads the rest of its settings (UPSTREAM_RATE, MAX_ACTIVE_SCANS, ...)
+from the environment as usual.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentile(values, p):
+    """Nearest-rank percentile; None for no values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+async def _wait_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.get(url, timeout=2)
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"{url} did not come up")
+                await asyncio.sleep(0.2)
+
+
+async def _scan_stream(client, app_url, car_number):
+    """(scan seconds, first-result seconds) or None if the scan failed."""
+    start = time.perf_counter()
+    first_result = None
+    body = {"id_number": "000000018", "car_number": car_number}
+    async with client.stream("POST", f"{app_url}/check-stream", json=body) as r:
+        if r.status_code != 200:
+            return None
+        async for line in r.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            event = json.loads(line[5:])
+            if event["type"] == "result" and first_result is None:
+                first_result = time.perf_counter() - start
+            elif event["type"] == "done":
+                return time.perf_counter() - start, first_result
+            elif event["type"] == "error":
+                return None
+    return None
+
+
+async def _scan_check(client, app_url, car_number):
+    start = time.perf_counter()
+    r = await client.post(f"{app_url}/check", json={"id_number": "000000018", "car_number": car_number})
+    if r.status_code != 200:
+        return None
+    return time.perf_counter() - start, None
+
+
+async def _run_level(app_url, endpoint, concurrency, scans, car_numbers):
+    scan = _scan_stream if endpoint == "check-stream" else _scan_check
+    queue = asyncio.Queue()
+    for _ in range(scans):
+        queue.put_nowait(next(car_numbers))
+    outcomes = []
+
+    async def worker(client):
+        while not queue.empty():
+            car_number = queue.get_nowait()
+            try:
+                outcomes.append(await scan(client, app_url, car_number))
+            except httpx.HTTPError:
+                outcomes.append(None)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=600, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        wall = time.perf_counter() - start
+
+    done = [o for o in outcomes if o is not None]
+    totals = [o[0] for o in done]
+    firsts = [o[1] for o in done if o[1] is not None]
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "ok": len(done),
+        "failed": len(outcomes) - len(done),
+        "p50": _percentile(totals, 50),
+        "p95": _percentile(totals, 95),
+        "p99": _percentile(totals, 99),
+        "first_p50": _percentile(firsts, 50),
+        "first_p95": _percentile(firsts, 95),
+        "scans_per_sec": len(done) / wall if wall else 0.0,
+    }
+
+
+def _fmt(seconds):
+    return f"{seconds:7.2f}" if seconds is not None else "      -"
+
+
+def _print_row(row):
+    print(
+        f"{row['endpoint']:12} {row['concurrency']:5} {row['ok']:5} {row['failed']:6}  "
+        f"{_fmt(row['p50'])} {_fmt(row['p95'])} {_fmt(row['p99'])}  "
+        f"{_fmt(row['first_p50'])} {_fmt(row['first_p95'])}  {row['scans_per_sec']:8.2f}"
+    )
+
+
+async def _bench(args, app_url):
+    await _wait_ready(app_url)
+    car_numbers = iter(f"{n:08d}" for n in range(int(time.time()) % 10**6 * 100, 10**9))
+    endpoints = ["check-stream", "check"] if args.endpoint == "both" else [args.endpoint]
+    print(f"{'endpoint':12} {'conc':>5} {'ok':>5} {'failed':>6}  {'p50 s':>7} {'p95 s':>7} {'p99 s':>7}  "
+          f"{'1st p50':>7} {'1st p95':>7}  {'scans/s':>8}")
+    rows = []
+    for endpoint in endpoints:
+        for concurrency in args.concurrency:
+            row = await _run_level(app_url, endpoint, concurrency, args.scans, car_numbers)
+            _print_row(row)
+            rows.append(row)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--concurrency", type=lambda s: [int(c) for c in s.split(",")], default=[1, 5, 20],
+                    help="comma-separated concurrent scan counts (default 1,5,20)")
+    ap.add_argument("--scans", type=int, default=20, help="scans per concurrency level")
+    ap.add_argument("--endpoint", choices=("check-stream", "check", "both"), default="both")
+    ap.add_argument("--app-url", help="benchmark an API that is already running instead of starting one")
+    ap.add_argument("--json", help="also write the results to this file")
+    stub = ap.add_argument_group("stub doh.co.il (see bench/stub_doh.py)")
+    stub.add_argument("--latency", type=float, default=50, help="mean upstream latency, ms")
+    stub.add_argument("--error-rate", type=float, default=0.0)
+    stub.add_argument("--fine-rate", type=float, default=0.1)
+    stub.add_argument("--fines", type=int, default=3)
+    args = ap.parse_args()
+
+    if args.app_url:
+        asyncio.run(_bench(args, args.app_url.rstrip("/")))
+        return
+
+    stub_port, app_port = _free_port(), _free_port()
+    env = {
+        **os.environ,
+        "UPSTREAM_OVERRIDE": f"http://127.0.0.1:{stub_port}",
+        "SCAN_LOG_BACKEND": "memory",
+        "IMAGE_CACHE_DIR": tempfile.mkdtemp(prefix="bench-images-"),
+    }
+    procs = [
+        subprocess.Popen([
+            sys.executable, os.path.join(ROOT, "bench", "stub_doh.py"), "--port", str(stub_port),
+            "--latency", str(args.latency), "--error-rate", str(args.error_rate),
+            "--fine-rate", str(args.fine_rate), "--fines", str(args.fines),
+        ]),
+        subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(app_port), "--log-level", "warning"],
+            cwd=ROOT, env=env,
+        ),
+    ]
+    try:
+        asyncio.run(_wait_ready(f"http://127.0.0.1:{stub_port}/step1.aspx"))
+        asyncio.run(_bench(args, f"http://127.0.0.1:{app_port}"))
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Step2 parser benchmark — checks parse_step2 against the BeautifulSoup reference
+on saved step2.aspx pages, then reports rows/sec for both.
+
+    python bench/bench_step2.py                      # pages in bench/fixtures/step2/
+    python bench/bench_step2.py saved/*.html -n 500  # your own saved pages
+
+Exits non-zero if the two parsers disagree on any page.
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from step2_parser import etree, parse_step2, parse_step2_soup  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "step2", "*.html")
+
+
+def _rate(parser, pages, iterations):
+    rows = 0
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for html in pages:
+            rows += len(parser(html)[0])
+    elapsed = time.perf_counter() - start
+    return rows / elapsed, elapsed * 1000 / (iterations * len(pages))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("pages", nargs="*", help="saved step2 pages (default: bench/fixtures/step2/*.html)")
+    ap.add_argument("-n", "--iterations", type=int, default=200, help="passes over all pages per parser")
+    args = ap.parse_args()
+
+    paths = args.pages or sorted(glob.glob(FIXTURES))
+    if not paths:
+        sys.exit("no step2 pages found")
+    pages = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            pages.append(f.read())
+
+    mismatches = 0
+    for path, html in zip(paths, pages):
+        fast, reference = parse_step2(html), parse_step2_soup(html)
+        status = "ok" if fast == reference else "MISMATCH"
+        mismatches += fast != reference
+        print(f"{status:8} {os.path.basename(path):28} {len(reference[0]):3} fines  total {reference[1]:.2f}")
+    if etree is None:
+        print("lxml is not installed — parse_step2 falls back to BeautifulSoup")
+
+    print()
+    for name, parser in (("BeautifulSoup", parse_step2_soup), ("lxml", parse_step2)):
+        rows_per_sec, ms_per_page = _rate(parser, pages, args.iterations)
+        print(f"{name:14} {rows_per_sec:10,.0f} rows/s   {ms_per_page:7.3f} ms/page")
+
+    if mismatches:
+        sys.exit(f"{mismatches} page(s) parsed differently")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Stub doh.co.il — replays recorded responses so scans can run offline.
+
+Serves the pages a check touches, from bench/fixtures/doh/ and
+bench/fixtures/step2/:
+
+    GET  /Default.aspx               sets the ASP.NET session cookie
+    POST /Menu/setParam.aspx         municipality config (JSON)
+    GET  /step1.aspx
+    POST /Check_Report.aspx          fine count — needs the session cookie, like the real site
+    GET  /step2.aspx                 fines table with --fines rows
+    POST /step2_show.aspx            image info for one fine
+    GET  /Hanita/Parking/Image.aspx  the fine photo (ws.comax.co.il)
+
+Whether a car has fines in a municipality is a stable hash of the two, so a
+repeated scan sees the same results. Point the API at it with
+UPSTREAM_OVERRIDE=http://127.0.0.1:<port>.
+
+    python bench/stub_doh.py --port 8081 --latency 80 --error-rate 0.01 --fine-rate 0.1 --fines 3
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import secrets
+from urllib.parse import parse_qs
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, JSONResponse, Response
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+SESSION_COOKIE = "ASP.NET_SessionId"
+
+
+def _fixture(*parts, mode="r"):
+    with open(os.path.join(FIXTURES, *parts), mode, **({} if "b" in mode else {"encoding": "utf-8"})) as f:
+        return f.read()
+
+
+def _split_step2(html):
+    """(page head, [row html], page tail) of a recorded step2 page."""
+    table = html.index("<table")
+    starts = [table + m.start() for m in re.finditer(r'<tr class="tableDiv data">', html[table:])]
+    end = html.index("</table>", starts[-1])
+    rows = [html[a:b] for a, b in zip(starts, starts[1:] + [end])]
+    return html[:starts[0]], rows, html[end:]
+
+
+def create_app(latency=0.05, jitter=0.5, error_rate=0.0, fine_rate=0.1, fines=3, images=2, require_session=True):
+    """latency in seconds, spread ±jitter (a fraction); rates are 0..1."""
+    app = FastAPI(title="doh.co.il stub")
+    rng = random.Random()
+
+    setparam = json.loads(_fixture("doh", "setparam.json"))
+    check_fine = json.loads(_fixture("doh", "check_report_fine.json"))
+    check_clean = json.loads(_fixture("doh", "check_report_clean.json"))
+    step2_show = json.loads(_fixture("doh", "step2_show.json"))
+    default_html = _fixture("doh", "default.html")
+    step1_html = _fixture("doh", "step1.html")
+    error_html = _fixture("doh", "error.html")
+    image = _fixture("doh", "image.jpg", mode="rb")
+    step2_head, step2_rows, step2_tail = _split_step2(_fixture("step2", "parking_many.html"))
+    prices = [float(p) for p in re.findall(r'data-price="([\d.]+)"', "".join(step2_rows))]
+
+    def step2_page(count):
+        rows = []
+        for i in range(count):
+            row = step2_rows[i % len(step2_rows)]
+            row = re.sub(r"<label>\d+</label>", f"<label>{3000000 + i}</label>", row)
+            rows.append(row)
+        return step2_head + "".join(rows) + step2_tail
+
+    step2_html = step2_page(fines)
+    fines_total = sum(prices[i % len(prices)] for i in range(fines))
+
+    def has_fines(session, car_number):
+        muni = session.split("-")[0]
+        digest = hashlib.sha256(f"{muni}|{car_number}".encode()).digest()
+        return int.from_bytes(digest[:4], "big") / 2 ** 32 < fine_rate
+
+    @app.middleware("http")
+    async def latency_and_errors(request: Request, call_next):
+        if latency:
+            await asyncio.sleep(latency * rng.uniform(1 - jitter, 1 + jitter))
+        if error_rate and rng.random() < error_rate:
+            return HTMLResponse(error_html, status_code=503)
+        return await call_next(request)
+
+    async def form(request: Request):
+        return {k: v[0] for k, v in parse_qs((await request.body()).decode()).items()}
+
+    @app.get("/Default.aspx")
+    async def default(request: Request):
+        muni = request.query_params.get("a") or request.query_params.get("Rashut", "")
+        response = HTMLResponse(default_html)
+        response.set_cookie(SESSION_COOKIE, f"{muni}-{secrets.token_hex(8)}", path="/", httponly=True)
+        return response
+
+    @app.post("/Menu/setParam.aspx")
+    async def set_param(request: Request):
+        data = await form(request)
+        return {**setparam, "Rashut": data.get("Rashut") or setparam["Rashut"]}
+
+    @app.get("/step1.aspx")
+    async def step1():
+        return HTMLResponse(step1_html)
+
+    @app.post("/Check_Report.aspx")
+    async def check_report(request: Request):
+        session = request.cookies.get(SESSION_COOKIE)
+        if session is None:
+            if require_session:
+                return HTMLResponse(error_html)  # the real site answers 200 with an error page
+            session = ""
+        data = await form(request)
+        if fines and has_fines(session, data.get("StrFind", "")):
+            return {**check_fine, "C": fines, "ItraSum": f"{fines_total:.0f}"}
+        return check_clean
+
+    @app.get("/step2.aspx")
+    async def step2():
+        return HTMLResponse(step2_html)
+
+    @app.post("/step2_show.aspx")
+    async def show(request: Request):
+        return JSONResponse({**step2_show, "PicFound": images})
+
+    @app.get("/Hanita/Parking/Image.aspx")
+    async def fine_image():
+        return Response(image, media_type="image/jpeg")
+
+    return app
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--latency", type=float, default=50, help="mean response latency, ms")
+    ap.add_argument("--jitter", type=float, default=0.5, help="latency spread, as a fraction of --latency")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered 503")
+    ap.add_argument("--fine-rate", type=float, default=0.1, help="fraction of municipalities where a car has fines")
+    ap.add_argument("--fines", type=int, default=3, help="fines per municipality with fines")
+    ap.add_argument("--images", type=int, default=2, help="photos per fine")
+    ap.add_argument("--no-session-check", action="store_true", help="accept Check_Report without the session cookie")
+    args = ap.parse_args()
+
+    app = create_app(
+        latency=args.latency / 1000, jitter=args.jitter, error_rate=args.error_rate,
+        fine_rate=args.fine_rate, fines=args.fines, images=args.images,
+        require_session=not args.no_session_check,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
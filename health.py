@@ -0,0 +1,155 @@
+"""
+Health registry — per-municipality success rate, latency and circuit breaker.
+
+Every check outcome is recorded against its municipality. When one keeps
+failing (failure_threshold failures in a row, or mostly failures over the
+recent window) its circuit opens, and checks fail fast instead of sitting
+through the site's chained timeouts.
+
+An open circuit is probed in the background once its cooldown has passed,
+with a cheap request that needs no user data. A passing probe half-opens the
+circuit: the next real check goes through as a trial, and its outcome closes
+the circuit or opens it again. Each failed probe or trial doubles the
+cooldown, up to max_open_seconds.
+
+    health = HealthRegistry(failure_threshold=5, open_seconds=30)
+    if not health.allow(key, probe):      # probe: async () -> bool
+        ...                               # fail fast: circuit_open
+    try:
+        ...
+        health.record(key, True, seconds)  # or health.record(key, False, error="timeout")
+    finally:
+        health.release(key)
+"""
+
+import asyncio
+import time
+from collections import deque
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+# Rate rule: open when at least this share of the window failed, given enough samples
+_FAILURE_RATIO = 0.8
+_MIN_SAMPLES = 10
+
+
+class _Circuit:
+    def __init__(self, window: int):
+        self.state = CLOSED
+        self.outcomes: deque[bool] = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.latency_ema: float | None = None
+        self.last_error: str | None = None
+        self.opened_at = 0.0
+        self.cooldown = 0.0
+        self.trial = False  # a half-open trial check is in flight
+        self.probe: asyncio.Task | None = None
+
+
+class HealthRegistry:
+    def __init__(self, failure_threshold: int = 5, open_seconds: float = 30.0,
+                 max_open_seconds: float = 600.0, window: int = 20):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.window = window
+        self._circuits: dict[str, _Circuit] = {}
+
+    def _circuit(self, key: str) -> _Circuit:
+        circuit = self._circuits.get(key)
+        if circuit is None:
+            circuit = self._circuits[key] = _Circuit(self.window)
+        return circuit
+
+    def allow(self, key: str, probe) -> bool:
+        """Whether a check may run now. Starts a background probe when an open circuit is due one."""
+        circuit = self._circuit(key)
+        if circuit.state == CLOSED:
+            return True
+        if circuit.state == HALF_OPEN:
+            if circuit.trial:
+                return False
+            circuit.trial = True
+            return True
+        if time.monotonic() - circuit.opened_at >= circuit.cooldown and circuit.probe is None:
+            circuit.probe = asyncio.create_task(self._probe(key, circuit, probe))
+        return False
+
+    async def _probe(self, key: str, circuit: _Circuit, probe) -> None:
+        try:
+            ok = await probe()
+        except Exception:
+            ok = False
+        finally:
+            circuit.probe = None
+        if circuit.state != OPEN:
+            return
+        if ok:
+            circuit.state = HALF_OPEN
+        else:
+            self._open(circuit, backoff=True)
+
+    def _open(self, circuit: _Circuit, backoff: bool = False) -> None:
+        circuit.state = OPEN
+        circuit.opened_at = time.monotonic()
+        circuit.trial = False
+        if backoff:
+            circuit.cooldown = min(self.max_open_seconds, max(self.open_seconds, circuit.cooldown * 2))
+        else:
+            circuit.cooldown = self.open_seconds
+
+    def record(self, key: str, ok: bool, seconds: float | None = None, error: str | None = None) -> None:
+        circuit = self._circuit(key)
+        circuit.outcomes.append(ok)
+        if seconds is not None:
+            circuit.latency_ema = seconds if circuit.latency_ema is None else 0.8 * circuit.latency_ema + 0.2 * seconds
+
+        if ok:
+            circuit.consecutive_failures = 0
+            if circuit.state == HALF_OPEN:
+                circuit.state = CLOSED
+                circuit.cooldown = 0.0
+                circuit.trial = False
+                circuit.outcomes.clear()  # start the rate rule over
+                circuit.outcomes.append(True)
+            return
+
+        circuit.consecutive_failures += 1
+        circuit.last_error = error
+        if circuit.state == HALF_OPEN:
+            self._open(circuit, backoff=True)
+        elif circuit.state == CLOSED:
+            failures = circuit.outcomes.count(False)
+            if (circuit.consecutive_failures >= self.failure_threshold
+                    or (len(circuit.outcomes) >= _MIN_SAMPLES and failures >= _FAILURE_RATIO * len(circuit.outcomes))):
+                self._open(circuit)
+
+    def release(self, key: str) -> None:
+        """End a check without an outcome (e.g. cancelled): frees the half-open trial."""
+        circuit = self._circuits.get(key)
+        if circuit is not None and circuit.state == HALF_OPEN:
+            circuit.trial = False
+
+    def state(self, key: str) -> str:
+        circuit = self._circuits.get(key)
+        return circuit.state if circuit is not None else CLOSED
+
+    @property
+    def open_count(self) -> int:
+        return sum(1 for c in self._circuits.values() if c.state != CLOSED)
+
+    def snapshot(self, key: str) -> dict:
+        circuit = self._circuits.get(key) or _Circuit(self.window)
+        samples = len(circuit.outcomes)
+        retry_in = None
+        if circuit.state == OPEN:
+            retry_in = round(max(0.0, circuit.opened_at + circuit.cooldown - time.monotonic()), 1)
+        return {
+            "state": circuit.state,
+            "success_rate": round(circuit.outcomes.count(True) / samples, 2) if samples else None,
+            "samples": samples,
+            "latency_ms": round(circuit.latency_ema * 1000) if circuit.latency_ema is not None else None,
+            "consecutive_failures": circuit.consecutive_failures,
+            "last_error": circuit.last_error,
+            "retry_in": retry_in,
+        }
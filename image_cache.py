@@ -0,0 +1,187 @@
+"""
+Image cache — a size-bounded on-disk LRU for proxied fine images.
+
+Fine images are immutable once issued, so they are keyed by what identifies
+them in the ws.comax.co.il URL (ReportNo / ReportC / ImageNumber), not by the
+full URL. Each entry is two files in the cache directory:
+
+    <key>.img   the image bytes
+    <key>.json  {"content_type": ...}
+
+Recency is the file mtime (bumped on every hit), so the LRU order survives a
+restart. When the total size goes over max_bytes the least recently used
+entries are deleted. The index is guarded by a lock, so the cache can be used
+from worker threads (asyncio.to_thread) and the event loop at once.
+
+    cache = ImageCache("image_cache", max_bytes=256 * 1024 * 1024)
+    entry = cache.get(key)            # (path, content_type) or None
+    writer = cache.writer(key, "image/jpeg")
+    writer.write(chunk); ...
+    writer.commit()                   # or writer.discard()
+
+Downscaled / recompressed variants (make_variant) need Pillow; without it
+VARIANTS_AVAILABLE is False and callers serve the original image.
+"""
+
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional: without it only originals are served
+    Image = None
+
+VARIANTS_AVAILABLE = Image is not None
+VARIANT_FORMATS = {"webp": "image/webp", "jpeg": "image/jpeg"}
+
+_KEY_PARAMS = ("ReportNo", "ReportC", "ImageNumber")
+
+
+def image_key(url: str) -> str:
+    """Cache key for an image URL: its ReportNo/ReportC/ImageNumber params, else the whole URL."""
+    query = {k.lower(): v for k, v in parse_qs(urlsplit(url).query).items()}
+    parts = [query.get(p.lower(), [""])[0] for p in _KEY_PARAMS]
+    ident = "|".join(parts) if all(parts) else url
+    return hashlib.sha256(ident.encode()).hexdigest()[:32]
+
+
+def make_variant(data: bytes, size: int | None, fmt: str) -> bytes:
+    """Re-encode an image as fmt (a VARIANT_FORMATS key), fitted into size x size px.
+
+    Never upscales. Raises OSError if the image can't be decoded.
+    """
+    with Image.open(io.BytesIO(data)) as im:
+        im = ImageOps.exif_transpose(im)  # phone photos: bake in the rotation
+        if size:
+            im.thumbnail((size, size))
+        if fmt == "jpeg" and im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        out = io.BytesIO()
+        im.save(out, format=fmt.upper(), quality=70 if fmt == "webp" else 80)
+    return out.getvalue()
+
+
+class CacheWriter:
+    """Collects one image as it streams in; only a committed image enters the cache."""
+
+    def __init__(self, cache: "ImageCache", key: str, content_type: str):
+        self._cache = cache
+        self._key = key
+        self._content_type = content_type
+        self._size = 0
+        fd, self._tmp = tempfile.mkstemp(dir=cache.directory, suffix=".part")
+        self._file = os.fdopen(fd, "wb")
+
+    def write(self, chunk: bytes) -> None:
+        self._file.write(chunk)
+        self._size += len(chunk)
+
+    def commit(self) -> None:
+        self._file.close()
+        self._cache._add(self._key, self._tmp, self._size, self._content_type)
+
+    def discard(self) -> None:
+        self._file.close()
+        try:
+            os.remove(self._tmp)
+        except OSError:
+            pass
+
+
+class ImageCache:
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, int] = OrderedDict()  # key -> size, oldest first
+        self._size = 0
+        self._lock = threading.Lock()  # guards _entries, _size and the hit counters
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _path(self, key: str, ext: str) -> str:
+        return os.path.join(self.directory, f"{key}.{ext}")
+
+    def _load(self) -> None:
+        found = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".part"):
+                os.remove(path)  # interrupted write from a previous run
+            elif name.endswith(".img") and os.path.exists(path[:-4] + ".json"):
+                st = os.stat(path)
+                found.append((st.st_mtime, name[:-4], st.st_size))
+        with self._lock:
+            for _, key, size in sorted(found):
+                self._entries[key] = size
+                self._size += size
+            self._evict()
+
+    def get(self, key: str) -> tuple[str, str] | None:
+        """(image path, content type) for a cached image, marking it recently used."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            path = self._path(key, "img")
+            try:
+                with open(self._path(key, "json")) as f:
+                    content_type = json.load(f)["content_type"]
+                os.utime(path)
+            except (OSError, ValueError, KeyError):
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return path, content_type
+
+    def writer(self, key: str, content_type: str) -> CacheWriter:
+        return CacheWriter(self, key, content_type)
+
+    def put(self, key: str, data: bytes, content_type: str) -> None:
+        writer = self.writer(key, content_type)
+        writer.write(data)
+        writer.commit()
+
+    def _add(self, key: str, tmp_path: str, size: int, content_type: str) -> None:
+        if size > self.max_bytes:
+            os.remove(tmp_path)
+            return
+        with self._lock:
+            with open(self._path(key, "json"), "w") as f:
+                json.dump({"content_type": content_type}, f)
+            os.replace(tmp_path, self._path(key, "img"))
+            self._size += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._evict()
+
+    def _remove(self, key: str) -> None:
+        """Drop an entry and its files. Caller holds the lock."""
+        self._size -= self._entries.pop(key, 0)
+        for ext in ("img", "json"):
+            try:
+                os.remove(self._path(key, ext))
+            except OSError:
+                pass
+
+    def _evict(self) -> None:
+        while self._size > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -1,20 +1,43 @@
 from fastapi import FastAPI, HTTPException, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response, FileResponse
 from pydantic import BaseModel
 from typing import Optional
-import requests
-import re
+from contextlib import asynccontextmanager, aclosing, contextmanager
+import httpx
 import asyncio
+import contextvars
 import json
-from concurrent.futures import ThreadPoolExecutor
-from bs4 import BeautifulSoup
+import math
+import random
+import hmac
+import hashlib
+import secrets
+from collections import OrderedDict, deque
+from functools import partial
+from pathlib import Path
 import time
 
-from scan_logger_supabase import log_scan, get_logs, get_log_by_id, get_stats, save_subscriber, update_scan_subscriber, update_scan_vehicle
+from metrics import Counter, Gauge, Histogram, render as render_metrics
+from rate_limiter import AdaptiveRateLimiter
+from scan_scheduler import FairScheduler
+from admission import AdmissionControl
+from health import HealthRegistry
+from step2_parser import parse_step2
+from image_cache import ImageCache, image_key, make_variant, VARIANTS_AVAILABLE, VARIANT_FORMATS
+from storage import log_scan, get_logs, get_log_by_id, get_stats, save_subscriber, update_scan_subscriber, update_scan_vehicle, update_scan_results
+from storage import close as close_scan_logs
 import os
 
-app = FastAPI(title="Parking Fines API", version="1.0.0")
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await _upstream_transport.aclose()
+    await asyncio.to_thread(close_scan_logs)  # drain queued scan logs
+
+
+app = FastAPI(title="Parking Fines API", version="1.0.0", lifespan=lifespan)
 
 # CORS — configurable via ALLOWED_ORIGINS env var (comma-separated), defaults to "*"
 _allowed_origins = os.environ.get("ALLOWED_ORIGINS", "*").split(",")
@@ -82,7 +105,157 @@ MUNI_COLORS = [
     "#9333ea", "#c026d3",
 ]
 
-stream_executor = ThreadPoolExecutor(max_workers=10)
+# Max municipality checks in flight across the whole process (all scans combined).
+# Checks are async, so this bounds open upstream handshakes, not threads.
+# Slots are handed out round-robin across scans, so a new scan's first checks
+# don't wait behind the whole fan-out of scans that arrived earlier.
+UPSTREAM_CONCURRENCY = int(os.environ.get("UPSTREAM_CONCURRENCY", "200"))
+_scheduler = FairScheduler(UPSTREAM_CONCURRENCY)
+
+# Process-wide keep-alive pool for doh.co.il and ws.comax.co.il, shared by every
+# check and image request so TLS handshakes are paid once per connection, not per check.
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", str(UPSTREAM_CONCURRENCY)))
+_upstream_transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(
+    max_connections=UPSTREAM_MAX_CONNECTIONS,
+    max_keepalive_connections=UPSTREAM_MAX_CONNECTIONS,
+    keepalive_expiry=60,
+))
+
+
+# Global adaptive limiter for doh.co.il requests, shared by all scans: it speeds up
+# while the site answers cleanly and backs off on errors, timeouts and bad responses.
+# Like scheduler slots, its tokens go round-robin across scans, so a new scan's
+# requests don't queue behind every request earlier scans are already waiting on.
+_doh_limiter = AdaptiveRateLimiter(
+    rate=float(os.environ.get("UPSTREAM_RATE", "20")),
+    min_rate=float(os.environ.get("UPSTREAM_RATE_MIN", "2")),
+    max_rate=float(os.environ.get("UPSTREAM_RATE_MAX", "200")),
+)
+
+
+# Send every upstream request to this base URL instead (paths and queries kept),
+# e.g. http://127.0.0.1:8081 for offline runs against bench/stub_doh.py.
+UPSTREAM_OVERRIDE = os.environ.get("UPSTREAM_OVERRIDE", "")
+
+
+def _is_doh(request):
+    return request.url.host.endswith("doh.co.il")
+
+
+def _routed(request):
+    """The request to put on the wire. A copy when overridden, so the client's
+    cookie jar still sees the real host on the response's request."""
+    if not UPSTREAM_OVERRIDE:
+        return request
+    target = httpx.URL(UPSTREAM_OVERRIDE)
+    url = request.url.copy_with(scheme=target.scheme, host=target.host, port=target.port)
+    return httpx.Request(request.method, url, headers=request.headers, stream=request.stream,
+                         extensions=request.extensions)
+
+
+class _SharedTransport(httpx.AsyncBaseTransport):
+    """Routes a client's requests through the shared pool; closing the client leaves the pool open."""
+
+    async def handle_async_request(self, request):
+        if not _is_doh(request):
+            return await _upstream_transport.handle_async_request(_routed(request))
+        started = time.perf_counter()
+        await _doh_limiter.acquire(*_scan_owner.get())
+        waited = time.perf_counter() - started
+        _limiter_wait.set(_limiter_wait.get() + waited)
+        _record_step("rate_limit", waited)
+        try:
+            response = await _upstream_transport.handle_async_request(_routed(request))
+        except httpx.TimeoutException:
+            _doh_limiter.record_failure("timeout")
+            raise
+        except httpx.TransportError as e:
+            _doh_limiter.record_failure(type(e).__name__)
+            raise
+        if response.status_code >= 500 or response.status_code == 429:
+            _doh_limiter.record_failure(f"HTTP {response.status_code}")
+        else:
+            _doh_limiter.record_success()
+        return response
+
+    async def aclose(self):
+        pass
+
+
+def _new_session():
+    """A client with its own cookie jar (ASP.NET session) on top of the shared connection pool."""
+    return httpx.AsyncClient(transport=_SharedTransport(), follow_redirects=True)
+
+
+# ─── Metrics (/metrics, Prometheus text format) ────────────
+# Each check records how long its steps took — queue (waiting for a scheduler
+# slot), rate_limit (waiting for doh.co.il rate limiter tokens), default,
+# setparam, step1, check_report, step2, step2_parse, step2_show (per image
+# lookup), images (all lookups, wall time) and total — into a per-municipality
+# histogram (labelled by rashut as well as name: names are not unique) and into the check's own breakdown (ms, summed per step), which is
+# sent back to clients that ask for it with debug. Upstream steps leave out
+# their rate limiter wait, so they show how slow the site itself is.
+STEP_SECONDS = Histogram("doh_step_seconds", "Latency of one step of a municipality check", ["municipality", "rashut", "step"])
+HEDGES = Counter("doh_hedged_checks_total", "Checks that started a hedged duplicate attempt", ["municipality", "rashut"])
+CHECK_ERRORS = Counter("doh_check_errors_total", "Failed municipality checks and retried steps, by reason", ["municipality", "rashut", "reason"])
+Gauge("scheduler_active_checks", "Municipality checks holding a scheduler slot", lambda: _scheduler.active)
+Gauge("scheduler_queued_checks", "Municipality checks waiting for a scheduler slot", lambda: _scheduler.queued)
+Gauge("scan_runs_in_flight", "Scans currently running", lambda: ScanRun.in_flight)
+Gauge("admission_active_scans", "Scans admitted by admission control", lambda: _admission.active)
+Gauge("admission_queued_scans", "Scans waiting for admission", lambda: _admission.queued)
+Gauge("open_circuits", "Municipalities whose circuit is open or half-open", lambda: _health.open_count)
+Gauge("doh_rate_limit", "Current doh.co.il request rate limit (req/s)", lambda: round(_doh_limiter.rate, 2))
+
+_check_context = contextvars.ContextVar("check_context", default=None)  # (municipality, rashut, timings)
+_limiter_wait = contextvars.ContextVar("limiter_wait", default=0.0)  # seconds this task spent waiting for rate limiter tokens
+_scan_owner = contextvars.ContextVar("scan_owner", default=(None, 0))  # (owner, priority) for the rate limiter's turns
+# {"deadline": time.monotonic() the check must end by, "cut": whether the latest step timeout was shortened to fit}
+_check_budget = contextvars.ContextVar("check_budget", default=None)
+
+
+def _current_check():
+    """(municipality, rashut, timings) of the check running in this task."""
+    return _check_context.get() or ("", "", None)
+
+
+def _record_step(step, seconds):
+    name, rashut, timings = _current_check()
+    STEP_SECONDS.observe(seconds, municipality=name, rashut=rashut, step=step)
+    if timings is not None:
+        timings[step] = round(timings.get(step, 0) + seconds * 1000, 1)
+
+
+@contextmanager
+def _timed(step):
+    """Time a step, minus any rate limiter wait inside it (recorded as rate_limit)."""
+    started = time.perf_counter()
+    waited = _limiter_wait.get()
+    try:
+        yield
+    finally:
+        _record_step(step, time.perf_counter() - started - (_limiter_wait.get() - waited))
+
+
+def _step_timeout(seconds):
+    """A step's HTTP timeout, cut down to what is left of the check's deadline."""
+    budget = _check_budget.get()
+    if budget is None:
+        return seconds
+    left = budget["deadline"] - time.monotonic()
+    budget["cut"] = left < seconds
+    return max(0.1, min(seconds, left))
+
+
+def _failure_reason(e):
+    if isinstance(e, (asyncio.TimeoutError, httpx.TimeoutException)):
+        return "timeout"
+    if isinstance(e, httpx.TransportError):
+        return "connection"
+    if isinstance(e, ValueError):
+        return "bad_response"  # e.g. Check_Report answered with HTML instead of JSON
+    if str(e).startswith("HTTP "):
+        return "http_status"
+    return "other"
 
 # Toggle: show total open fines count per municipality
 SHOW_TOTAL_OPEN_FINES = True
@@ -93,6 +266,7 @@ class CheckRequest(BaseModel):
     car_number: str
     latitude: Optional[float] = None
     longitude: Optional[float] = None
+    debug: bool = False  # attach per-step timings to results and check_metadata
 
 
 class SubscribeRequest(BaseModel):
@@ -102,7 +276,7 @@ class SubscribeRequest(BaseModel):
     scan_id: Optional[int] = None
 
 
-def _get_fine_images(session, base, car_number, report_type, language, sw_show, rashut, report_c, sw_hide_pic_parking, sw_hide_pic_general):
+async def _get_fine_images(session, base, car_number, report_type, language, sw_show, rashut, report_c, sw_hide_pic_parking, sw_hide_pic_general):
     """Call step2_show.aspx for a single fine to get image URLs."""
     try:
         # Check if images should be hidden for this report type
@@ -114,19 +288,20 @@ def _get_fine_images(session, base, car_number, report_type, language, sw_show,
         import base64
         str_find_encoded = "1" + base64.b64encode(car_number.encode()).decode() + "2"
 
-        r = session.post(f"{base}/step2_show.aspx", data={
-            "status": "view",
-            "ReportC": report_c,
-            "StrFind": str_find_encoded,
-            "ReportType": report_type,
-            "language": language,
-            "SwShow": sw_show or "",
-        }, headers={
-            **HEADERS,
-            "Referer": f"{base}/step2.aspx",
-            "X-Requested-With": "XMLHttpRequest",
-            "Content-Type": "application/x-www-form-urlencoded",
-        }, timeout=15)
+        with _timed("step2_show"):
+            r = await session.post(f"{base}/step2_show.aspx", data={
+                "status": "view",
+                "ReportC": report_c,
+                "StrFind": str_find_encoded,
+                "ReportType": report_type,
+                "language": language,
+                "SwShow": sw_show or "",
+            }, headers={
+                **HEADERS,
+                "Referer": f"{base}/step2.aspx",
+                "X-Requested-With": "XMLHttpRequest",
+                "Content-Type": "application/x-www-form-urlencoded",
+            }, timeout=_step_timeout(15))
 
         if r.status_code != 200:
             return []
@@ -153,91 +328,39 @@ def _get_fine_images(session, base, car_number, report_type, language, sw_show,
         return []
 
 
-def _get_fines_from_step2(session, base, car_number, id_number, report_type, doch_c, rashut, sw_qr, language, param_resp=None):
+async def _get_fines_from_step2(session, base, car_number, id_number, report_type, doch_c, rashut, sw_qr, language, param_resp=None):
     try:
         step2_url = (
             f"{base}/step2.aspx?StrFind={car_number}&ReportNo={id_number}"
             f"&status=GetDetails&ReportType={report_type}&DochC={doch_c}"
             f"&SwQR=0&language={language}&Rashut={rashut}&SwOrder=2"
         )
-        r = session.get(step2_url, headers={**HEADERS, "Referer": f"{base}/step1.aspx"}, timeout=45)
+        with _timed("step2"):
+            r = await session.get(step2_url, headers={**HEADERS, "Referer": f"{base}/step1.aspx"}, timeout=_step_timeout(45))
         if r.status_code != 200:
             return {"status": "failed", "error": f"step2 HTTP {r.status_code}"}
 
-        soup = BeautifulSoup(r.text, "html.parser")
-        fines = []
-        total = 0.0
-        for row in soup.select("tr.tableDiv.data, tr[class*='tableDiv'][class*='data']"):
-            fine = {}
-            label = row.find("label")
-            if label:
-                fine["number"] = label.get_text(strip=True)
-            checkbox = row.find("input", {"type": "checkbox"})
-            if checkbox and checkbox.get("data-price"):
-                try:
-                    price = float(checkbox["data-price"])
-                    fine["amount"] = price
-                    total += price
-                except ValueError:
-                    pass
-                # Extract ReportC from checkbox name attribute
-                if checkbox.get("name"):
-                    fine["_report_c"] = checkbox["name"]
-            price_el = row.find(class_="price")
-            if price_el:
-                fine["price_display"] = price_el.get_text(strip=True)
-
-            # Extract ReportC from the view link (data-class attribute)
-            view_link = row.find("a", attrs={"data-class": True})
-            if view_link:
-                fine["_report_c"] = view_link["data-class"]
-
-            # Parse all cell divs in order matching column layout:
-            # [checkbox, number, date, time, location, amount, comments, view]
-            cell_divs = row.find_all("div", class_="cell")
-            for div in cell_divs:
-                text = div.get_text(strip=True)
-                classes = div.get("class", [])
-                if re.match(r"\d{2}/\d{2}/\d{4}", text):
-                    fine["date"] = text
-                elif re.match(r"\d{2}:\d{2}$", text):
-                    fine["time"] = text
-                elif div.get("id") == "Street" or ("w4" in classes and "nomobile" in classes and "location" not in fine and "price" not in classes):
-                    # Location column (w4 nomobile, first occurrence)
-                    if text and "location" not in fine and not div.find(class_="price"):
-                        fine["location"] = text
-                elif "w4" in classes and "nomobile" in classes and "location" in fine and "comments" not in fine:
-                    # Comments column (w4 nomobile, second occurrence after location)
-                    if text:
-                        fine["comments"] = text
-            if fine:
-                fines.append(fine)
-
-        # Fetch images for each fine that has a ReportC
-        if fines and param_resp:
-            sw_hide_pic_parking = param_resp.get("SwHidePicParking", "0")
-            sw_hide_pic_general = param_resp.get("SwHidePicGeneral", "0")
-            sw_show = param_resp.get("SwShow", "")
-
-            for fine in fines:
-                report_c = fine.pop("_report_c", None)
-                if report_c:
-                    image_urls = _get_fine_images(
-                        session, base, car_number, report_type, language,
-                        sw_show, rashut, report_c, sw_hide_pic_parking, sw_hide_pic_general
-                    )
-                    if image_urls:
-                        fine["image_urls"] = image_urls
-        else:
-            # Remove internal _report_c keys even if we couldn't fetch images
-            for fine in fines:
-                fine.pop("_report_c", None)
+        with _timed("step2_parse"):
+            fines, total = parse_step2(r.text)
+
+        # Image URLs are looked up later, by _resolve_images, so the fines can be
+        # reported without waiting for one step2_show round trip per fine
+        for fine in fines:
+            report_c = fine.pop("_report_c", None)
+            if report_c and param_resp:
+                fine["_image_lookup"] = partial(
+                    _get_fine_images, session, base, car_number, report_type, language,
+                    param_resp.get("SwShow", ""), rashut, report_c,
+                    param_resp.get("SwHidePicParking", "0"), param_resp.get("SwHidePicGeneral", "0"),
+                )
 
         if fines:
             return {"status": "fine", "count": len(fines), "amount": f"{total:.2f}" if total > 0 else "ראה פרטים", "fines": fines}
         # step2 returned no data rows — the C value was system-wide, not personal
         return {"status": "clean"}
     except Exception as e:
+        check_name, check_rashut, _ = _current_check()
+        CHECK_ERRORS.inc(municipality=check_name, rashut=check_rashut, reason="step2")
         return {"status": "fine", "count": doch_c, "amount": f"לא ידוע (step2 שגיאה: {e})"}
 
 
@@ -248,61 +371,364 @@ def _build_payment_url(rashut, report_type, qcode=None):
     return f"{base}/Default.aspx?ReportType={report_type}&Rashut={rashut}"
 
 
-def check_municipality(name, rashut, report_type, id_number, car_number, qcode=None):
-    base = "https://www.doh.co.il"
+# ─── setParam metadata cache ───────────────────────────────
+# Menu/setParam.aspx (action=getData) returns municipality configuration —
+# Rashut, SwQR, language, SwHidePicParking, SwHidePicGeneral, SwShow — which is
+# the same for every user. Cache it per rashut/qcode so checks know the real
+# rashut and image-hiding flags before any request goes out, and the lean
+# handshake can skip the POST.
+PARAM_CACHE_TTL = int(os.environ.get("PARAM_CACHE_TTL", "21600"))  # seconds
+# Entries older than this fraction of the TTL are refreshed in the background
+# while the cached value keeps being served.
+PARAM_REFRESH_AHEAD = 0.8
 
-    # Small random delay to avoid burst patterns that trigger rate-limiting
-    import random
-    time.sleep(random.uniform(0.1, 0.6))
+_param_cache = {}  # key -> (fetched_at, param_resp)
+_param_refresh_tasks = {}  # key -> asyncio.Task
 
-    try:
-        session = requests.Session()
-        return _do_check(session, base, name, rashut, report_type, id_number, car_number, qcode)
-    except Exception as e:
-        return {"name": name, "status": "failed", "error": str(e)}
 
+def _param_key(rashut, report_type, qcode=None):
+    return f"q:{qcode}" if qcode else f"{report_type}:{rashut}"
 
-def _do_check(session, base, name, rashut, report_type, id_number, car_number, qcode=None):
+
+def _page_url(base, rashut, report_type, qcode=None):
     if qcode:
-        page_url = f"{base}/Default.aspx?a={qcode}"
-    else:
-        page_url = f"{base}/Default.aspx?ReportType={report_type}&Rashut={rashut}"
-    session.get(page_url, headers=HEADERS, timeout=15)
+        return f"{base}/Default.aspx?a={qcode}"
+    return f"{base}/Default.aspx?ReportType={report_type}&Rashut={rashut}"
+
 
+async def _fetch_param(session, base, page_url, rashut, report_type, qcode=None):
+    """POST setParam.aspx and cache the response. Returns the parsed dict, or None."""
     if qcode:
         param_data = {"action": "getData", "a": qcode}
     else:
         param_data = {"action": "getData", "ReportType": report_type, "Rashut": rashut, "language": "", "SwShow": "", "TK": ""}
 
-    r_param = session.post(f"{base}/Menu/setParam.aspx", data=param_data, headers={
+    r_param = await session.post(f"{base}/Menu/setParam.aspx", data=param_data, headers={
         **HEADERS, "Referer": page_url, "X-Requested-With": "XMLHttpRequest", "Content-Type": "application/x-www-form-urlencoded"
-    }, timeout=15)
+    }, timeout=_step_timeout(15))
 
-    param_resp = None
     try:
         param_resp = r_param.json()
-        actual_rashut = str(param_resp.get("Rashut", rashut))
-        sw_qr = str(param_resp.get("SwQR", "0"))
-        language = str(param_resp.get("language", "he"))
-    except:
-        actual_rashut = rashut
-        sw_qr = "1" if qcode else "0"
-        language = "he"
+    except ValueError:
+        return None
+    if not isinstance(param_resp, dict):
+        return None
+    _param_cache[_param_key(rashut, report_type, qcode)] = (time.monotonic(), param_resp)
+    return param_resp
+
+
+async def _refresh_param(base, rashut, report_type, qcode=None):
+    key = _param_key(rashut, report_type, qcode)
+    try:
+        page_url = _page_url(base, rashut, report_type, qcode)
+        async with _new_session() as session:
+            await session.get(page_url, headers=HEADERS, timeout=15)
+            await _fetch_param(session, base, page_url, rashut, report_type, qcode)
+    except Exception:
+        pass  # the stale entry stays until it expires; the next check refetches inline
+    finally:
+        _param_refresh_tasks.pop(key, None)
+
+
+def _get_cached_param(base, rashut, report_type, qcode=None):
+    """Return cached setParam metadata, or None if missing/expired."""
+    key = _param_key(rashut, report_type, qcode)
+    entry = _param_cache.get(key)
+    if not entry:
+        return None
+    fetched_at, param_resp = entry
+    age = time.monotonic() - fetched_at
+    if age > PARAM_CACHE_TTL:
+        return None
+    if age > PARAM_CACHE_TTL * PARAM_REFRESH_AHEAD and key not in _param_refresh_tasks:
+        # A fresh context: not the triggering check's deadline, timings or rate limiter turn
+        _param_refresh_tasks[key] = asyncio.create_task(_refresh_param(base, rashut, report_type, qcode),
+                                                        context=contextvars.Context())
+    return param_resp
+
+
+def _param_fields(param_resp, rashut, qcode=None):
+    """(actual_rashut, sw_qr, language) from setParam metadata, with the old fallbacks."""
+    if not param_resp:
+        return rashut, "1" if qcode else "0", "he"
+    return (
+        str(param_resp.get("Rashut", rashut)),
+        str(param_resp.get("SwQR", "0")),
+        str(param_resp.get("language", "he")),
+    )
+
+
+# ─── Lean handshake ────────────────────────────────────────
+# The full chain before Check_Report is GET Default.aspx, POST setParam.aspx,
+# GET step1.aspx. Some of those may only set cookies the site never checks.
+# With LEAN_HANDSHAKE on, each municipality learns which steps it can drop:
+# one unknown step is probed per check by asking Check_Report with the shortened
+# chain and then with the full one; the step is only marked skippable when both
+# report the same fines. A session missing context may answer "no fines", so a
+# probe where the full chain finds none proves nothing: it is left undecided and
+# probed again on a later check. A shortened chain that Check_Report rejects (200 with a non-JSON page) is retried
+# with the full chain and its skipped steps marked required. 5xx/429 answers are
+# ordinary errors, not rejections.
+LEAN_HANDSHAKE = os.environ.get("LEAN_HANDSHAKE", "0") == "1"
+# Learned states (skippable or required) expire and are probed again after this many seconds
+HANDSHAKE_RELEARN = int(os.environ.get("HANDSHAKE_RELEARN", "21600"))
+
+# Probe order: step1 is the most likely to be cookie-only.
+# setparam can only be dropped while its metadata is cached.
+_HANDSHAKE_STEPS = ("step1", "default", "setparam")
+_handshake_profiles = {}  # param key -> {step: (state, decided_at)}, state "skippable"/"required"
+
+
+class _HandshakeRejected(Exception):
+    """Check_Report rejected a shortened handshake chain."""
+
+
+def _plan_handshake(key, param_cached):
+    """Pick the handshake steps to skip for this check: (skip, probe).
+
+    skip holds every known-skippable step plus at most one untested step, probe.
+    """
+    if not LEAN_HANDSHAKE:
+        return frozenset(), None
+    profile = _handshake_profiles.get(key, {})
+    now = time.monotonic()
+    skip = set()
+    probe = None
+    for step in _HANDSHAKE_STEPS:
+        if step == "setparam" and not param_cached:
+            continue
+        state, decided_at = profile.get(step, (None, 0))
+        if state is not None and now - decided_at > HANDSHAKE_RELEARN:
+            state = None
+        if state == "skippable":
+            skip.add(step)
+        elif state is None and probe is None:
+            skip.add(step)
+            probe = step
+    return frozenset(skip), probe
+
+
+def _same_answer(lean, full):
+    """Whether a shortened chain's Check_Report answer matches the full chain's."""
+    return all(lean.get(k) == full.get(k) for k in ("C", "ItraSum"))
+
+
+def _has_fines(data):
+    """Whether a Check_Report answer reports any fines (C > 0)."""
+    try:
+        return int(data.get("C") or 0) > 0
+    except (TypeError, ValueError):
+        return False
+
+
+def _record_handshake(key, skip, probe, ok):
+    profile = _handshake_profiles.setdefault(key, {})
+    now = time.monotonic()
+    if ok:
+        for step in skip:
+            profile[step] = ("skippable", now)
+    elif probe:
+        # Everything else in the chain was already known to be skippable
+        profile[probe] = ("required", now)
+    else:
+        # A chain of known-skippable steps stopped working — relearn all of them
+        for step in skip:
+            profile[step] = ("required", now)
+
+
+# ─── Municipality health: circuit breaker ──────────────────
+# Every check outcome is recorded per municipality — except checks cut off by
+# the scan deadline (including step timeouts shortened to fit it), which say
+# more about our own queueing than about the site. After CIRCUIT_FAILURES
+# failures in a row (or a mostly-failing recent window) its circuit opens and
+# checks fail at once with error "circuit_open", instead of holding a scheduler
+# slot through the site's chained timeouts. Once CIRCUIT_OPEN_SECONDS pass, a
+# background probe (Default.aspx + setParam, no user data) decides whether the
+# next real check may go through as a trial; failed probes and trials double the
+# wait, up to CIRCUIT_MAX_OPEN_SECONDS. State is served at /municipality-health.
+_health = HealthRegistry(
+    failure_threshold=int(os.environ.get("CIRCUIT_FAILURES", "5")),
+    open_seconds=float(os.environ.get("CIRCUIT_OPEN_SECONDS", "30")),
+    max_open_seconds=float(os.environ.get("CIRCUIT_MAX_OPEN_SECONDS", "600")),
+)
+
+
+async def _probe_municipality(base, rashut, report_type, qcode=None):
+    """Whether the municipality's site answers its handshake (and refresh its setParam cache)."""
+    page_url = _page_url(base, rashut, report_type, qcode)
+    async with _new_session() as session:
+        r = await session.get(page_url, headers=HEADERS, timeout=15)
+        if r.status_code != 200:
+            return False
+        return await _fetch_param(session, base, page_url, rashut, report_type, qcode) is not None
+
+
+async def check_municipality(name, rashut, report_type, id_number, car_number, qcode=None, owner=None, priority=0,
+                             on_result=None, on_images=None, timings=None, deadline=None):
+    """Check one municipality. owner/priority identify the scan for fair scheduling.
 
-    session.get(f"{base}/step1.aspx", headers={**HEADERS, "Referer": page_url}, timeout=15)
+    Fine image URLs are looked up after the fines themselves. With on_result the
+    result is handed over (await on_result(result)) before that starts; each fine
+    then gets its image_urls as they resolve, announced by await on_images(result, index).
+    Pass a dict as timings to get the per-step breakdown (ms) filled in. With a
+    deadline (time.monotonic()) every step's timeout is capped to the time left.
+    """
+    base = "https://www.doh.co.il"
+    key = _param_key(rashut, report_type, qcode)
+    if not _health.allow(key, partial(_probe_municipality, base, rashut, report_type, qcode)):
+        CHECK_ERRORS.inc(municipality=name, rashut=rashut, reason="circuit_open")
+        return {"name": name, "status": "failed", "error": "circuit_open"}
+
+    owner = owner if owner is not None else object()
+    context = _check_context.set((name, rashut, timings))
+    owner_token = _scan_owner.set((owner, priority))
+    budget = {"deadline": deadline, "cut": False} if deadline is not None else None
+    budget_token = _check_budget.set(budget)
+    started = time.perf_counter()
+    try:
+        async with _scheduler.slot(owner, priority):
+            _record_step("queue", time.perf_counter() - started)
+            checked_at = time.perf_counter()
+            waited = _limiter_wait.get()
+            result = await _check_with_handshake(base, key, name, rashut, report_type, id_number, car_number, qcode,
+                                                 on_result, on_images)
+    except Exception as e:
+        reason = _failure_reason(e)
+        if reason == "timeout" and budget is not None and budget["cut"]:
+            reason = "deadline"  # ran out of the scan's budget: not the municipality's fault
+        else:
+            _health.record(key, False, error=reason)
+        CHECK_ERRORS.inc(municipality=name, rashut=rashut, reason=reason)
+        return {"name": name, "status": "failed", "error": "timeout" if reason in ("timeout", "deadline") else str(e)}
+    else:
+        _health.record(key, True, time.perf_counter() - checked_at - (_limiter_wait.get() - waited))
+        return result
+    finally:
+        _health.release(key)
+        _record_step("total", time.perf_counter() - started)
+        _check_budget.reset(budget_token)
+        _scan_owner.reset(owner_token)
+        _check_context.reset(context)
+
+
+async def _check_with_handshake(base, key, name, rashut, report_type, id_number, car_number, qcode,
+                                on_result, on_images):
+    skip, probe = _plan_handshake(key, _get_cached_param(base, rashut, report_type, qcode) is not None)
+    lean = None  # a probe's Check_Report answer, to confirm against the full chain
+    if skip:
+        try:
+            async with _new_session() as session:
+                if probe is None:
+                    result = await _do_check(session, base, name, rashut, report_type, id_number, car_number, qcode, skip)
+                    return await _resolve_images(result, on_result, on_images)
+                lean, _ = await _run_handshake(session, base, rashut, report_type, id_number, car_number, qcode, skip)
+        except _HandshakeRejected:
+            _record_handshake(key, skip, probe, False)
+            CHECK_ERRORS.inc(municipality=name, rashut=rashut, reason="handshake_rejected")
+
+    # Fresh client per check: its cookie jar holds this check's ASP.NET session
+    async with _new_session() as session:
+        report = await _run_handshake(session, base, rashut, report_type, id_number, car_number, qcode)
+        if lean is not None:
+            if not _same_answer(lean, report[0]):
+                _record_handshake(key, skip, probe, False)
+                CHECK_ERRORS.inc(municipality=name, rashut=rashut, reason="handshake_mismatch")
+            elif _has_fines(report[0]):
+                _record_handshake(key, skip, probe, True)
+            # else both said "no fines": inconclusive, the probe runs again next time
+        result = await _do_check(session, base, name, rashut, report_type, id_number, car_number, qcode, report=report)
+        return await _resolve_images(result, on_result, on_images)
+
+
+async def _resolve_images(result, on_result=None, on_images=None):
+    """Hand the result over, then look up its fines' image URLs concurrently.
+
+    Runs while the check's session is still open — step2_show needs its cookies.
+    """
+    fines = result.get("fines", [])
+    lookups = [(i, fine.pop("_image_lookup")) for i, fine in enumerate(fines) if "_image_lookup" in fine]
+    if on_result is not None:
+        await on_result(result)
+
+    async def resolve(i, lookup):
+        image_urls = await lookup()
+        if image_urls:
+            fines[i]["image_urls"] = image_urls
+            if on_images is not None:
+                await on_images(result, i)
+
+    if lookups:
+        with _timed("images"):
+            await asyncio.gather(*(resolve(i, lookup) for i, lookup in lookups))
+    return result
 
-    r = session.post(f"{base}/Check_Report.aspx", data={
+
+async def _post_check_report(session, base, report_type, id_number, car_number):
+    return await session.post(f"{base}/Check_Report.aspx", data={
         "status": "Check_Report", "StrFind": car_number, "ReportNo": id_number,
         "ReportType": report_type, "tokenCaptcha": "", "SwShow": "", "SwOrder": "2"
     }, headers={
         **HEADERS, "Referer": f"{base}/step1.aspx", "Origin": base,
         "Content-Type": "application/x-www-form-urlencoded", "X-Requested-With": "XMLHttpRequest",
-    }, timeout=45)
+    }, timeout=_step_timeout(45))
+
+
+def _check_report_rejected(r):
+    """A 200 that isn't a JSON object: the site's answer to a session it doesn't recognise."""
+    if r.status_code != 200:
+        return False
+    try:
+        return not isinstance(r.json(), dict)
+    except ValueError:
+        return True
+
+
+def _check_report_json(r):
+    """Parse Check_Report's JSON, telling the rate limiter when the site answers with something else."""
+    try:
+        return r.json()
+    except ValueError:
+        _doh_limiter.record_failure("non-JSON Check_Report")
+        raise
+
+
+async def _run_handshake(session, base, rashut, report_type, id_number, car_number, qcode=None, skip=frozenset()):
+    """The chain up to and including Check_Report, minus the steps in skip. Returns (data, param_resp)."""
+    page_url = _page_url(base, rashut, report_type, qcode)
+    if "default" not in skip:
+        with _timed("default"):
+            await session.get(page_url, headers=HEADERS, timeout=_step_timeout(15))
+
+    # Municipality config (actual rashut, SwQR, image-hiding flags) comes from the cache
+    # whenever it is there. setParam is still POSTed for the session's sake unless the
+    # lean handshake learned it can be skipped; its answer refreshes the cache.
+    param_resp = _get_cached_param(base, rashut, report_type, qcode)
+    if param_resp is None or "setparam" not in skip:
+        with _timed("setparam"):
+            fetched = await _fetch_param(session, base, page_url, rashut, report_type, qcode)
+        param_resp = param_resp or fetched
+
+    if "step1" not in skip:
+        with _timed("step1"):
+            await session.get(f"{base}/step1.aspx", headers={**HEADERS, "Referer": page_url}, timeout=_step_timeout(15))
+
+    with _timed("check_report"):
+        r = await _post_check_report(session, base, report_type, id_number, car_number)
+
+    if skip and _check_report_rejected(r):
+        raise _HandshakeRejected(f"Check_Report rejected handshake without {', '.join(sorted(skip))}")
 
     if r.status_code != 200:
         raise Exception(f"HTTP {r.status_code}")
 
-    data = r.json()
+    return _check_report_json(r), param_resp
+
+
+async def _do_check(session, base, name, rashut, report_type, id_number, car_number, qcode=None, skip=frozenset(),
+                    report=None):
+    """Check one municipality in session. report: a (data, param_resp) already fetched in it by _run_handshake."""
+    data, param_resp = report or await _run_handshake(session, base, rashut, report_type, id_number, car_number, qcode, skip)
+    actual_rashut, sw_qr, language = _param_fields(param_resp, rashut, qcode)
     count = data.get("C", 0)
     itra_sum = data.get("ItraSum", "")
 
@@ -317,7 +743,7 @@ def _do_check(session, base, name, rashut, report_type, id_number, car_number, q
         return result
 
     if itra_sum:
-        step2_result = _get_fines_from_step2(session, base, car_number, id_number, report_type, count, actual_rashut, sw_qr, language, param_resp)
+        step2_result = await _get_fines_from_step2(session, base, car_number, id_number, report_type, count, actual_rashut, sw_qr, language, param_resp)
         if step2_result.get("status") == "fine" and step2_result.get("fines"):
             result = {"name": name, "status": "fine", "count": step2_result["count"],
                       "amount": itra_sum, "person_name": data.get("Nm", ""),
@@ -329,7 +755,7 @@ def _do_check(session, base, name, rashut, report_type, id_number, car_number, q
             result["total_open_fines"] = total_open
         return result
 
-    result = _get_fines_from_step2(session, base, car_number, id_number, report_type, count, actual_rashut, sw_qr, language, param_resp)
+    result = await _get_fines_from_step2(session, base, car_number, id_number, report_type, count, actual_rashut, sw_qr, language, param_resp)
     result["name"] = name
     if result.get("status") == "fine":
         result["payment_url"] = payment_url
@@ -339,13 +765,309 @@ def _do_check(session, base, name, rashut, report_type, id_number, car_number, q
 
 
 def _enrich_result(result, rashut):
-    """Add address/phone metadata to a check result."""
+    """Add the rashut (municipality names are not unique) and address/phone metadata to a check result."""
+    result["rashut"] = rashut
     meta = _MUNI_META.get(rashut, {})
     result["address"] = meta.get("address", "")
     result["phone"] = meta.get("phone", "")
     return result
 
 
+# ─── Scan runs: short-TTL result cache + in-flight coalescing ─────
+# A ScanRun is one fan-out over all municipalities. Identical (id_number,
+# car_number) requests share the run while it is in flight, and replay its
+# results for RESULT_CACHE_TTL seconds after it finishes. Runs are keyed by a
+# salted HMAC of the pair, so raw IDs are never used as cache keys.
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", "60"))
+RESULT_CACHE_MAX = int(os.environ.get("RESULT_CACHE_MAX", "256"))
+_RESULT_CACHE_SALT = os.environ.get("RESULT_CACHE_SALT", "").encode() or secrets.token_bytes(32)
+
+# Upper bound for a single municipality check (all its round trips together)
+MUNICIPALITY_TIMEOUT = 60
+# Whole-scan budget: checks still running this many seconds after the run
+# started are cancelled and reported as failed with error "timeout". Step
+# timeouts inside a check shrink to fit what is left of it.
+SCAN_DEADLINE = float(os.environ.get("SCAN_DEADLINE", "45"))
+
+# Hedged checks: a check that has not handed over a result after the recent p95
+# of start -> result times (at least HEDGE_MIN_DELAY seconds) gets a duplicate
+# attempt; whichever hands over a result first wins and the other is cancelled.
+# Skipped while checks are queueing for scheduler slots, so hedges only use spare capacity.
+HEDGE_REQUESTS = os.environ.get("HEDGE_REQUESTS", "1") == "1"
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", "2"))
+# Base delay (seconds) before a run with retries re-tries a failed check; doubles per retry
+RETRY_BACKOFF = float(os.environ.get("RETRY_BACKOFF", "1"))
+
+_HEDGE_MIN_SAMPLES = 20
+_HEDGE_MAX_SHARE = 0.1  # at most this share of a run's checks are hedged, so a slow site isn't hit twice as hard
+_result_seconds = deque(maxlen=1000)  # recent start -> result times of successful checks
+
+
+def _hedge_delay():
+    """Seconds after which a check is hedged, or None (disabled, or not enough history)."""
+    if not HEDGE_REQUESTS or len(_result_seconds) < _HEDGE_MIN_SAMPLES:
+        return None
+    ordered = sorted(_result_seconds)
+    return max(HEDGE_MIN_DELAY, ordered[math.ceil(0.95 * len(ordered)) - 1])
+
+
+class ScanRun:
+    """Checks every municipality (or the given subset) once; any number of subscribers can iterate its events.
+
+    Events are {"type": "result", "result": ...} per municipality, followed by
+    {"type": "images", "name", "rashut", "number", "index", "image_urls"} per fine whose
+    images resolved. self.results holds the results, with image_urls filled in.
+
+    The run ends SCAN_DEADLINE seconds after it started at the latest; slow
+    checks may be hedged with a duplicate attempt (see HEDGE_REQUESTS). With
+    retries, a failed check is tried again that many times, with backoff.
+
+    When the last subscriber goes away before the run finishes, the run is aborted:
+    pending checks and their in-flight HTTP calls are cancelled.
+    """
+
+    in_flight = 0  # runs not finished yet, for /metrics
+
+    def __init__(self, id_number, car_number, priority=0, ticket=None, municipalities=None, retries=0):
+        self.municipalities = MUNICIPALITIES if municipalities is None else municipalities
+        self.retries = retries
+        self.priority = priority
+        self.ticket = ticket  # admission slot held until the run finishes
+        self.results = []
+        self.events = []
+        self.timings = {}  # rashut -> per-step breakdown (ms)
+        self.finished_at = None
+        self.aborted = False
+        self.deadline = time.monotonic() + SCAN_DEADLINE
+        self.deadline_hit = False  # some check (or its images) was cut off by the run deadline
+        self.hedge_delay = _hedge_delay()
+        self.hedges_left = max(1, int(len(self.municipalities) * _HEDGE_MAX_SHARE))
+        self._subscribers = 0
+        self._cond = asyncio.Condition()
+        self._task = asyncio.create_task(self._run(id_number, car_number))
+        ScanRun.in_flight += 1
+
+    @property
+    def done(self):
+        return self.finished_at is not None
+
+    async def _emit(self, event):
+        async with self._cond:
+            if event["type"] == "result":
+                self.results.append(event["result"])
+            self.events.append(event)
+            self._cond.notify_all()
+
+    async def _on_images(self, result, index):
+        fine = result["fines"][index]
+        await self._emit({
+            "type": "images", "name": result["name"], "rashut": result["rashut"],
+            "number": fine.get("number"), "index": index, "image_urls": fine["image_urls"],
+        })
+
+    async def _check_one(self, m, id_number, car_number):
+        for retry in range(self.retries + 1):
+            result = await self._attempt_check(m, id_number, car_number)
+            if result is None:
+                return  # handed over
+            delay = RETRY_BACKOFF * 2 ** retry * random.uniform(0.5, 1.5)
+            if retry == self.retries or time.monotonic() + delay >= self.deadline:
+                break
+            await asyncio.sleep(delay)
+        await self._emit({"type": "result", "result": _enrich_result(result, m["rashut"])})
+
+    async def _attempt_check(self, m, id_number, car_number):
+        """Run one check (hedged if slow). Returns None once a result was handed over, else the failed result."""
+        key = _param_key(m["rashut"], m["report_type"], m.get("qcode"))
+        timings = self.timings.setdefault(m["rashut"], {})
+        started = time.monotonic()
+        deadline = min(started + MUNICIPALITY_TIMEOUT, self.deadline)
+        attempts = []
+        winner = None  # the attempt whose result was handed over
+
+        def start_attempt():
+            attempt = len(attempts)
+
+            async def on_result(result):
+                nonlocal winner
+                if winner is not None:
+                    raise asyncio.CancelledError  # the other attempt got there first
+                winner = attempt
+                for i, task in enumerate(attempts):
+                    if i != attempt:
+                        task.cancel()
+                if result["status"] != "failed":
+                    _result_seconds.append(time.monotonic() - started)
+                await self._emit({"type": "result", "result": _enrich_result(result, m["rashut"])})
+
+            attempts.append(asyncio.create_task(check_municipality(
+                m["name"], m["rashut"], m["report_type"],
+                id_number, car_number, m.get("qcode"),
+                owner=self, priority=self.priority,
+                on_result=on_result, on_images=self._on_images,
+                timings=timings, deadline=deadline,
+            )))
+
+        result = None
+        start_attempt()
+        try:
+            while True:
+                pending = [t for t in attempts if not t.done()]
+                if not pending:
+                    break
+                now = time.monotonic()
+                if now >= deadline:
+                    if deadline >= self.deadline:
+                        self.deadline_hit = True
+                    break
+                hedge_at = None
+                if self.hedge_delay is not None and len(attempts) == 1 and winner is None:
+                    hedge_at = started + self.hedge_delay
+                    if now >= hedge_at:
+                        hedge_at = None
+                        if (self.hedges_left and deadline - now > self.hedge_delay
+                                and not _scheduler.queued and _health.state(key) == "closed"):
+                            self.hedges_left -= 1
+                            start_attempt()
+                            HEDGES.inc(municipality=m["name"], rashut=m["rashut"])
+                            continue
+                await asyncio.wait(pending, timeout=min(deadline, hedge_at or deadline) - now,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                for i, task in enumerate(attempts):
+                    if task.done() and not task.cancelled() and (winner is None or i == winner):
+                        result = task.result()  # a failed attempt's result stands until another succeeds
+        finally:
+            for task in attempts:
+                task.cancel()
+            await asyncio.gather(*attempts, return_exceptions=True)
+
+        if winner is not None:
+            return None  # images not resolved by the deadline are left out
+        if result is None:
+            # Cut off by the deadline — possibly after waiting on our own scheduler or rate
+            # limiter — so not held against the municipality's health
+            CHECK_ERRORS.inc(municipality=m["name"], rashut=m["rashut"], reason="deadline")
+            result = {"name": m["name"], "status": "failed", "error": "timeout"}
+        return result
+
+    async def _run(self, id_number, car_number):
+        try:
+            await asyncio.gather(*(self._check_one(m, id_number, car_number) for m in self.municipalities))
+        finally:
+            ScanRun.in_flight -= 1
+            if self.ticket is not None:
+                self.ticket.release()
+            async with self._cond:
+                self.finished_at = time.monotonic()
+                self._cond.notify_all()
+
+    def _unsubscribe(self):
+        self._subscribers -= 1
+        if self._subscribers == 0 and not self.done:
+            self.aborted = True
+            self._task.cancel()
+
+    async def iter_events(self):
+        """Yield events in the order they happened — replayed instantly for a finished run.
+
+        Close the iterator (e.g. with contextlib.aclosing) when abandoning it early,
+        so an unwatched run gets cancelled promptly.
+        """
+        self._subscribers += 1
+        try:
+            i = 0
+            while True:
+                async with self._cond:
+                    await self._cond.wait_for(lambda: i < len(self.events) or self.done)
+                    batch = self.events[i:]
+                if not batch:
+                    return
+                for event in batch:
+                    yield event
+                i += len(batch)
+        finally:
+            self._unsubscribe()
+
+
+def _summarize(results):
+    return {
+        "clean": sum(1 for r in results if r["status"] == "clean"),
+        "fine": sum(1 for r in results if r["status"] == "fine"),
+        "failed": sum(1 for r in results if r["status"] == "failed"),
+    }
+
+
+def _log_scan_quietly(*args, **kwargs):
+    """log_scan only queues the row, so it's safe on the event loop; never break the response over logging."""
+    try:
+        return log_scan(*args, **kwargs)
+    except Exception:
+        return None
+
+
+_scan_runs = OrderedDict()  # salted key -> ScanRun, least recently used first
+
+
+def _scan_key(id_number, car_number):
+    return hmac.new(_RESULT_CACHE_SALT, f"{id_number}\0{car_number}".encode(), hashlib.sha256).hexdigest()
+
+
+def _find_scan_run(id_number, car_number):
+    """The in-flight or recently finished run for this pair, if any."""
+    run = _scan_runs.get(_scan_key(id_number, car_number))
+    if run is not None and (run.aborted or (run.done and time.monotonic() - run.finished_at > RESULT_CACHE_TTL)):
+        return None
+    return run
+
+
+def _get_scan_run(id_number, car_number, priority=0, ticket=None):
+    """Join the in-flight or recently finished run for this pair, or start a new one.
+
+    A new run takes over the admission ticket; joining an existing run releases it.
+    """
+    key = _scan_key(id_number, car_number)
+    run = _find_scan_run(id_number, car_number)
+    if run is None:
+        run = ScanRun(id_number, car_number, priority, ticket)
+        _scan_runs[key] = run
+    elif ticket is not None:
+        ticket.release()
+    _scan_runs.move_to_end(key)
+    while len(_scan_runs) > RESULT_CACHE_MAX:
+        _scan_runs.popitem(last=False)  # an evicted in-flight run keeps running for its subscribers
+    return run
+
+
+# ─── Admission control ───────────────────────────────────
+# At most MAX_ACTIVE_SCANS new scans run at once; up to SCAN_QUEUE_SIZE more wait
+# (streaming clients get 'queued' events), and beyond that we answer 503.
+# Joining an in-flight or cached run needs no admission.
+MAX_ACTIVE_SCANS = int(os.environ.get("MAX_ACTIVE_SCANS", "20"))
+SCAN_QUEUE_SIZE = int(os.environ.get("SCAN_QUEUE_SIZE", "50"))
+_admission = AdmissionControl(MAX_ACTIVE_SCANS, SCAN_QUEUE_SIZE)
+
+
+def _busy_error():
+    return HTTPException(
+        status_code=503,
+        detail="השירות עמוס כרגע, נסו שוב בעוד מספר שניות",
+        headers={"Retry-After": str(_admission.retry_after())},
+    )
+
+
+def _reserve_scan(id_number, car_number):
+    """An admission ticket for a new scan, or None if the pair's run can be joined.
+
+    Raises 503 when the wait queue is full.
+    """
+    if _find_scan_run(id_number, car_number) is not None:
+        return None
+    ticket = _admission.reserve()
+    if ticket is None:
+        raise _busy_error()
+    return ticket
+
+
 @app.get("/")
 def root():
     return {"status": "ok", "message": "Parking Fines API is running"}
@@ -353,6 +1075,37 @@ def root():
 
 # Build a lookup from rashut -> {address, phone} for enriching results
 _MUNI_META = {m["rashut"]: {"address": m.get("address", ""), "phone": m.get("phone", "")} for m in MUNICIPALITIES}
+_MUNI_ORDER = {m["rashut"]: i for i, m in enumerate(MUNICIPALITIES)}
+
+
+@app.get("/upstream-status")
+def upstream_status():
+    """Current doh.co.il rate limiter state, for monitoring."""
+    return {
+        "rate_limiter": _doh_limiter.snapshot(),
+        "scheduler": _scheduler.snapshot(),
+        "admission": _admission.snapshot(),
+        "image_cache": _image_cache.snapshot(),
+        "open_circuits": _health.open_count,
+    }
+
+
+@app.get("/municipality-health")
+def municipality_health(state: Optional[str] = Query(None, description="closed, open or half_open")):
+    """Per-municipality success rate, latency (EMA, ms) and circuit state."""
+    rows = []
+    for m in MUNICIPALITIES:
+        row = {"name": m["name"], "rashut": m["rashut"],
+               **_health.snapshot(_param_key(m["rashut"], m["report_type"], m.get("qcode")))}
+        if state is None or row["state"] == state:
+            rows.append(row)
+    return rows
+
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus metrics: per-step check latency, check errors, queue and scan gauges."""
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 @app.get("/municipalities")
@@ -384,140 +1137,294 @@ def get_municipalities():
     return {"municipalities": result, "total": len(result)}
 
 
-from fastapi.responses import Response
+# ─── Fine image proxy: streamed, with an on-disk LRU cache ───
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR") or os.path.join(os.path.dirname(__file__), "image_cache")
+IMAGE_CACHE_MAX_MB = int(os.environ.get("IMAGE_CACHE_MAX_MB", "256"))
+_image_cache = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_MB * 1024 * 1024)
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """If-None-Match check (weak comparison, as RFC 9110 requires for it)."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return etag.removeprefix("W/") in tags
+
+
+# Thumbnail sizes (longest side, px); a requested size snaps up to one of these
+# so the number of cached variants per image stays bounded
+IMAGE_VARIANT_SIZES = (160, 320, 640, 1280)
+
+
+async def _image_variant(request: Request, url: str, key: str, size: int | None, fmt: str, headers: dict):
+    """A downscaled / recompressed copy of the image, made once and cached."""
+    variant_key = f"{key}-{size or 0}-{fmt}"
+    headers["ETag"] = f'"{variant_key}"'
+    headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    if _etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    cached = await asyncio.to_thread(_image_cache.get, variant_key)
+    if cached is not None:
+        path, content_type = cached
+        return FileResponse(path, media_type=content_type, headers=headers)
+
+    original = await asyncio.to_thread(_image_cache.get, key)
+    if original is not None:
+        path, original_type = original
+        data = await asyncio.to_thread(Path(path).read_bytes)
+    else:
+        try:
+            async with _new_session() as session:
+                r = await session.get(url, headers=HEADERS, timeout=15)
+        except httpx.HTTPError:
+            raise HTTPException(status_code=502, detail="Failed to fetch image")
+        if r.status_code != 200:
+            raise HTTPException(status_code=r.status_code, detail="Image not found")
+        data, original_type = r.content, r.headers.get("Content-Type", "image/jpeg")
+        await asyncio.to_thread(_image_cache.put, key, data, original_type)
+
+    try:
+        body = await asyncio.to_thread(make_variant, data, size, fmt)
+    except OSError:
+        # Not an image Pillow can read — pass the original through
+        return Response(content=data, media_type=original_type, headers=headers)
+    await asyncio.to_thread(_image_cache.put, variant_key, body, VARIANT_FORMATS[fmt])
+    return Response(content=body, media_type=VARIANT_FORMATS[fmt], headers=headers)
+
 
 @app.get("/fine-image")
-def proxy_fine_image(url: str = Query(..., description="Full image URL from ws.comax.co.il")):
+async def proxy_fine_image(
+    request: Request,
+    url: str = Query(..., description="Full image URL from ws.comax.co.il"),
+    size: Optional[int] = Query(None, gt=0, description="Fit into size x size px (thumbnail)"),
+    format: Optional[str] = Query(None, description="webp or jpeg (default: webp if the browser accepts it)"),
+):
     """Proxy fine images to avoid CORS issues in the browser."""
     if not url.startswith("https://ws.comax.co.il/"):
         raise HTTPException(status_code=400, detail="Invalid image URL")
+    if format is not None and format not in VARIANT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(VARIANT_FORMATS)}")
+
+    # A fine image never changes, so its cache key doubles as the ETag
+    key = image_key(url)
+    headers = {"Cache-Control": "public, max-age=86400", "ETag": f'"{key}"'}
+
+    if (size or format) and VARIANTS_AVAILABLE:
+        if size:
+            size = next((s for s in IMAGE_VARIANT_SIZES if s >= size), IMAGE_VARIANT_SIZES[-1])
+        if format is None:
+            headers["Vary"] = "Accept"
+            format = "webp" if "image/webp" in request.headers.get("accept", "") else "jpeg"
+        return await _image_variant(request, url, key, size, format, headers)
+
+    if _etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    cached = await asyncio.to_thread(_image_cache.get, key)
+    if cached is not None:
+        path, content_type = cached
+        return FileResponse(path, media_type=content_type, headers=headers)
+
+    session = _new_session()
     try:
-        r = requests.get(url, headers=HEADERS, timeout=15)
-        if r.status_code != 200:
-            raise HTTPException(status_code=r.status_code, detail="Image not found")
-        content_type = r.headers.get("Content-Type", "image/jpeg")
-        return Response(content=r.content, media_type=content_type, headers={
-            "Cache-Control": "public, max-age=86400",
-        })
-    except requests.exceptions.RequestException:
+        r = await session.send(session.build_request("GET", url, headers=HEADERS, timeout=15), stream=True)
+    except httpx.HTTPError:
+        await session.aclose()
         raise HTTPException(status_code=502, detail="Failed to fetch image")
+    if r.status_code != 200:
+        await r.aclose()
+        await session.aclose()
+        raise HTTPException(status_code=r.status_code, detail="Image not found")
+    content_type = r.headers.get("Content-Type", "image/jpeg")
+
+    # Cache file I/O (temp file, chunk writes, commit and its evictions) runs in
+    # worker threads so a slow disk doesn't stall the event loop
+    async def body():
+        try:
+            writer = await asyncio.to_thread(_image_cache.writer, key, content_type)
+        except OSError:
+            writer = None  # cache dir unwritable — still serve the image
+        try:
+            async for chunk in r.aiter_bytes():
+                if writer:
+                    await asyncio.to_thread(writer.write, chunk)
+                yield chunk
+        except BaseException:
+            if writer:
+                # Upstream failed or client went away mid-image; not awaited, as we may be cancelled
+                asyncio.get_running_loop().run_in_executor(None, writer.discard)
+            raise
+        else:
+            if writer:
+                await asyncio.to_thread(writer.commit)
+        finally:
+            await r.aclose()
+            await session.aclose()
 
+    return StreamingResponse(body(), media_type=content_type, headers=headers)
 
-@app.post("/check-stream")
-async def check_stream(req: CheckRequest, request: Request):
-    if not req.id_number.strip() or not req.car_number.strip():
+
+def _scan_pair(req: CheckRequest):
+    """The stripped (id_number, car_number) of a scan request; 400 if either is empty."""
+    id_number, car_number = req.id_number.strip(), req.car_number.strip()
+    if not id_number or not car_number:
         raise HTTPException(status_code=400, detail="id_number and car_number are required")
+    return id_number, car_number
+
+
+def _log_check(req: CheckRequest, request: Request, run, results, aborted=False):
+    """Log a scan's results; returns the scan ID (None if logging failed)."""
+    return _log_scan_quietly(
+        request.client.host if request.client else "", req.id_number.strip(), req.car_number.strip(),
+        results, _summarize(results),
+        user_agent=request.headers.get("user-agent", ""),
+        latitude=req.latitude,
+        longitude=req.longitude,
+        aborted=aborted,
+        timings=run.timings if req.debug else None,
+    )
 
-    client_ip = request.client.host if request.client else ""
-    user_agent = request.headers.get("user-agent", "")
 
-    async def event_generator():
-        yield f"data: {json.dumps({'type': 'start', 'total': len(MUNICIPALITIES)}, ensure_ascii=False)}\n\n"
+def _sse(event):
+    """One server-sent event carrying event as JSON."""
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
 
-        loop = asyncio.get_event_loop()
-        results = []
 
-        async def check_one(m):
-            try:
-                return await loop.run_in_executor(
-                    stream_executor,
-                    check_municipality,
-                    m["name"], m["rashut"], m["report_type"],
-                    req.id_number.strip(), req.car_number.strip(),
-                    m.get("qcode")
-                )
-            except Exception as e:
-                return {"name": m["name"], "status": "failed", "error": str(e)}
+def _sse_response(events):
+    return StreamingResponse(events, media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "Connection": "keep-alive",
+        "X-Accel-Buffering": "no",
+    })
 
-        tasks = [asyncio.create_task(check_one(m)) for m in MUNICIPALITIES]
 
-        # Build name -> rashut lookup for enrichment
-        name_to_rashut = {m["name"]: m["rashut"] for m in MUNICIPALITIES}
+async def _wait_admitted(ticket, request: Request):
+    """Wait for a scan slot, yielding SSE 'queued' events that tell the client where it stands.
 
-        for coro in asyncio.as_completed(tasks):
-            result = await coro
-            _enrich_result(result, name_to_rashut.get(result.get("name", ""), ""))
-            results.append(result)
-            yield f"data: {json.dumps({'type': 'result', 'result': result}, ensure_ascii=False)}\n\n"
+    If the client goes away first, the ticket is released and ticket.admitted stays False.
+    """
+    try:
+        while not ticket.admitted:
+            yield _sse({"type": "queued", "position": ticket.position, "estimated_wait": ticket.estimated_wait})
+            if await request.is_disconnected():
+                return
+            await ticket.wait(timeout=5)
+    finally:
+        if not ticket.admitted:
+            ticket.release()
+
+
+async def _scan_events(request: Request, reserve, start_run, total, finish, debug=False):
+    """The SSE side of a scan, shared by /check-stream and rescans.
+
+    reserve() returns an admission ticket (None if none is needed) or raises
+    HTTPException; start_run(ticket) starts or joins the ScanRun. Its events are
+    forwarded until it ends or the client goes away, then
+    await finish(run, results, completed) returns the done event's fields (not
+    sent if the client left). With debug, result events carry their timings.
+    """
+    try:
+        ticket = reserve()
+    except HTTPException as e:
+        yield _sse({"type": "error", "detail": e.detail})
+        return
 
-        summary = {
-            "clean": sum(1 for r in results if r["status"] == "clean"),
-            "fine": sum(1 for r in results if r["status"] == "fine"),
-            "failed": sum(1 for r in results if r["status"] == "failed"),
-        }
+    if ticket is not None:
+        async for event in _wait_admitted(ticket, request):
+            yield event
+        if not ticket.admitted:
+            return
 
-        # Log the completed scan and get the scan ID
-        scan_id = None
-        try:
-            scan_id = log_scan(
-                client_ip, req.id_number.strip(), req.car_number.strip(),
-                results, summary,
-                user_agent=user_agent,
-                latitude=req.latitude,
-                longitude=req.longitude,
-            )
-        except Exception:
-            pass  # never break the response over logging
-
-        yield f"data: {json.dumps({'type': 'done', 'summary': summary, 'scan_id': scan_id}, ensure_ascii=False)}\n\n"
-
-    return StreamingResponse(
-        event_generator(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        }
-    )
+    # Hand the ticket to the run before yielding again, so it can't leak
+    run = start_run(ticket)
+    yield _sse({"type": "start", "total": total})
 
+    results = []
+    completed = False
+    try:
+        async with aclosing(run.iter_events()) as run_events:
+            async for event in run_events:
+                if event["type"] == "result":
+                    results.append(event["result"])
+                    if debug:
+                        event = {**event, "timings": run.timings.get(event["result"]["rashut"], {})}
+                yield _sse(event)
+                if await request.is_disconnected():
+                    return
+        completed = True
+    finally:
+        # Also when the client went away (EventSource closed / generator cancelled):
+        # closing the iterator cancels the run if nobody else watches it
+        done = await finish(run, results, completed)
+    yield _sse({"type": "done", **done})
 
-@app.post("/check")
-def check_all(req: CheckRequest, request: Request):
-    if not req.id_number.strip() or not req.car_number.strip():
-        raise HTTPException(status_code=400, detail="id_number and car_number are required")
 
-    client_ip = request.client.host if request.client else ""
-    user_agent = request.headers.get("user-agent", "")
+@app.post("/check-stream")
+async def check_stream(req: CheckRequest, request: Request):
+    id_number, car_number = _scan_pair(req)
 
-    results = []
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = {
-            executor.submit(
-                check_municipality,
-                m["name"], m["rashut"], m["report_type"],
-                req.id_number.strip(), req.car_number.strip(),
-                m.get("qcode")
-            ): m for m in MUNICIPALITIES
-        }
-        for future in futures:
-            try:
-                result = future.result(timeout=60)
-                _enrich_result(result, futures[future]["rashut"])
-                results.append(result)
-            except Exception as e:
-                m = futures[future]
-                results.append({"name": m["name"], "status": "failed", "error": str(e)})
-
-    summary = {
-        "clean": sum(1 for r in results if r["status"] == "clean"),
-        "fine": sum(1 for r in results if r["status"] == "fine"),
-        "failed": sum(1 for r in results if r["status"] == "failed"),
-    }
+    # Reject up front while we can still answer with a status code; the actual
+    # reservation happens inside the stream so it is always released
+    if _find_scan_run(id_number, car_number) is None and _admission.full:
+        _admission.reject()
+        raise _busy_error()
 
-    # Log the completed scan
-    try:
-        log_scan(
-            client_ip, req.id_number.strip(), req.car_number.strip(),
-            results, summary,
-            user_agent=user_agent,
-            latitude=req.latitude,
-            longitude=req.longitude,
-        )
-    except Exception:
-        pass  # never break the response over logging
+    async def finish(run, results, completed):
+        # Log what we got; a scan the client left is logged as aborted
+        scan_id = _log_check(req, request, run, results, aborted=not completed)
+        return {"summary": _summarize(results), "scan_id": scan_id}
+
+    return _sse_response(_scan_events(
+        request,
+        reserve=lambda: _reserve_scan(id_number, car_number),
+        start_run=lambda ticket: _get_scan_run(id_number, car_number, ticket=ticket),
+        total=len(MUNICIPALITIES), finish=finish, debug=req.debug,
+    ))
+
+
+@app.post("/check")
+async def check_all(req: CheckRequest, request: Request):
+    """The whole scan in one response, run on the same ScanRun engine as /check-stream."""
+    id_number, car_number = _scan_pair(req)
+    deadline = time.monotonic() + CHECK_DEADLINE
 
-    return {"results": results, "summary": summary}
+    ticket = _reserve_scan(id_number, car_number)
+    if ticket is not None:
+        try:
+            while not ticket.admitted:
+                if time.monotonic() >= deadline:
+                    raise _busy_error()
+                await ticket.wait(timeout=deadline - time.monotonic())
+        except BaseException:
+            ticket.release()
+            raise
+    run = _get_scan_run(id_number, car_number, ticket=ticket)
+
+    partial_results = False
+    try:
+        async with asyncio.timeout(max(0.0, deadline - time.monotonic())):
+            async with aclosing(run.iter_events()) as run_events:
+                async for _ in run_events:
+                    pass  # wait for the run, image lookups included
+    except TimeoutError:
+        partial_results = True  # leaving the run cancels it unless someone else is watching
+    results = _with_timeouts(list(run.results))
+    # Keep the response in municipality order, as before
+    results.sort(key=lambda r: _MUNI_ORDER.get(r.get("rashut"), len(_MUNI_ORDER)))
+    # Partial whenever something was cut short: a municipality timed out, or the run
+    # hit its deadline with image lookups still pending
+    partial_results = (partial_results or run.deadline_hit
+                       or any(r.get("error") == "timeout" for r in results))
+
+    scan_id = _log_check(req, request, run, results)
+
+    if req.debug:
+        results = [{**r, "timings": run.timings.get(r["rashut"], {})} for r in results]
+    return {"results": results, "summary": _summarize(results), "scan_id": scan_id, "partial": partial_results}
 
 
 # ─── Scan Logs Endpoints ───────────────────────────────────
@@ -526,14 +1433,15 @@ def check_all(req: CheckRequest, request: Request):
 def scan_logs(
     limit: int = Query(default=50, ge=1, le=500),
     offset: int = Query(default=0, ge=0),
+    before_id: Optional[int] = Query(default=None, description="Cursor: return logs older than this id"),
 ):
-    """Return recent scan log entries (newest first)."""
-    logs = get_logs(limit=limit, offset=offset)
-    # Strip raw_results from list view for brevity
-    for log in logs:
-        meta = log.get("check_metadata") or {}
-        meta.pop("raw_results", None)
-    return {"logs": logs, "count": len(logs)}
+    """Return recent scan log entries (newest first), without raw_results.
+
+    Page with before_id=<next_before_id from the previous page>.
+    """
+    logs = get_logs(limit=limit, offset=offset, before_id=before_id)
+    next_before_id = logs[-1]["id"] if len(logs) == limit else None
+    return {"logs": logs, "count": len(logs), "next_before_id": next_before_id}
 
 
 @app.get("/scan-logs/{log_id}")
@@ -548,6 +1456,58 @@ def scan_log_detail(log_id: int):
     return entry
 
 
+# Retries per municipality when re-checking a scan's failures
+RESCAN_RETRIES = int(os.environ.get("RESCAN_RETRIES", "2"))
+
+
+@app.post("/scan-logs/{scan_id}/rescan")
+async def rescan_failed(scan_id: int, request: Request):
+    """Re-check only the municipalities that failed in a logged scan, over SSE.
+
+    Events are as in /check-stream (start, result, images, done). Failed checks
+    are retried RESCAN_RETRIES times with backoff; the new results are merged
+    into the scan's row, and done carries the merged summary.
+    """
+    entry = await asyncio.to_thread(get_log_by_id, scan_id)
+    if not entry:
+        raise HTTPException(status_code=404, detail="Scan log not found")
+    id_number = entry["user_info"]["id_number"]
+    car_number = entry["vehicle"]["car_number"]
+    failed = [r for r in entry["check_metadata"].get("raw_results") or [] if r.get("status") == "failed"]
+    failed_rashuts = {r["rashut"] for r in failed if r.get("rashut")}
+    failed_names = {r.get("name") for r in failed if not r.get("rashut")}  # rows logged before results had a rashut
+    municipalities = [m for m in MUNICIPALITIES if m["rashut"] in failed_rashuts or m["name"] in failed_names]
+
+    if municipalities and _admission.full:
+        _admission.reject()
+        raise _busy_error()
+
+    def reserve():
+        if not municipalities:
+            return None  # nothing to re-check: just report the logged summary
+        ticket = _admission.reserve()
+        if ticket is None:
+            raise _busy_error()
+        return ticket
+
+    def start_run(ticket):
+        return ScanRun(id_number, car_number, ticket=ticket, municipalities=municipalities, retries=RESCAN_RETRIES)
+
+    async def finish(run, results, completed):
+        # Keep whatever was re-checked, even if the client left early
+        merged = await asyncio.to_thread(update_scan_results, scan_id, results) if results else None
+        fines = merged or entry["fines"]
+        if merged:
+            # The cached run for this pair still holds the old failures
+            cached = _find_scan_run(id_number, car_number)
+            if cached is not None and cached.done:
+                _scan_runs.pop(_scan_key(id_number, car_number), None)
+        summary = {"clean": fines["clean_count"], "fine": fines["fine_count"], "failed": fines["failed_count"]}
+        return {"summary": summary, "scan_id": scan_id}
+
+    return _sse_response(_scan_events(request, reserve, start_run, len(municipalities), finish))
+
+
 @app.get("/scan-stats")
 def scan_stats():
     """Return aggregate scan statistics."""
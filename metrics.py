@@ -0,0 +1,117 @@
+"""
+Metrics — counters, gauges and histograms rendered in the Prometheus text format.
+
+Just enough of the Prometheus data model for /metrics, without the client
+library: every metric registers itself in REGISTRY on creation, and render()
+produces the text exposition format (version 0.0.4).
+
+    CHECKS = Counter("checks_total", "Municipality checks", ["status"])
+    CHECKS.inc(status="clean")
+    LATENCY = Histogram("step_seconds", "Step latency", ["step"])
+    LATENCY.observe(0.42, step="check_report")
+    Gauge("queue_depth", "Checks waiting for a slot", lambda: scheduler.queued)
+"""
+
+import math
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 45)
+
+REGISTRY = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra="") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(n, "") for n in self.label_names)
+
+    def _samples(self):
+        return []
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {_number(value)}" for name, labels, value in self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels=()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        for key, value in sorted(self._values.items()):
+            yield self.name, _labels(self.label_names, key), value
+
+
+class Gauge(_Metric):
+    """A value read at scrape time from fn()."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn):
+        super().__init__(name, help)
+        self._fn = fn
+
+    def _samples(self):
+        yield self.name, "", self._fn()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._series: dict[tuple, list] = {}  # labels -> [bucket counts..., sum]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * len(self.buckets) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-1] += value
+
+    def _samples(self):
+        for key, series in sorted(self._series.items()):
+            for bound, count in zip(self.buckets, series):
+                yield f"{self.name}_bucket", _labels(self.label_names, key, f'le="{_number(bound)}"'), count
+            yield f"{self.name}_sum", _labels(self.label_names, key), series[-1]
+            yield f"{self.name}_count", _labels(self.label_names, key), series[len(self.buckets) - 1]
+
+
+def render() -> str:
+    """Every registered metric in the Prometheus text format."""
+    return "\n".join(m.render() for m in REGISTRY) + "\n"
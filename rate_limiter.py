@@ -0,0 +1,136 @@
+"""
+Adaptive rate limiter — a token bucket whose refill rate follows AIMD.
+
+Every request to an upstream host takes one token. While the upstream is
+healthy the rate creeps up additively (+increase req/s for roughly every
+second of successful traffic); on an HTTP error, timeout or malformed response
+it is cut multiplicatively. Decreases are rate-limited to one per cooldown, so
+a burst of failures from the same moment only backs off once.
+
+Tokens are handed out round-robin across owners (scans), like the fair
+scheduler's slots: when requests queue up, one token goes to scan A, one to
+scan B, one to A, ... so a new scan's requests don't wait behind everything
+earlier scans already queued. Higher priorities are served first.
+
+    limiter = AdaptiveRateLimiter(rate=20, min_rate=2, max_rate=200)
+    await limiter.acquire(scan, priority=0)
+    ...
+    limiter.record_success()   # or limiter.record_failure("HTTP 503")
+"""
+
+import asyncio
+import time
+
+from scan_scheduler import WaiterRotation
+
+
+class AdaptiveRateLimiter:
+    def __init__(
+        self,
+        rate: float,
+        min_rate: float,
+        max_rate: float,
+        burst: float | None = None,
+        increase: float = 5.0,
+        decrease: float = 0.5,
+        cooldown: float = 1.0,
+    ):
+        self.rate = float(rate)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.burst = float(burst) if burst is not None else max(1.0, self.rate / 2)
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+
+        self._tokens = self.burst
+        self._refilled_at = time.monotonic()
+        self._waiters = WaiterRotation()
+        self._dispatcher: asyncio.Task | None = None
+        self._waiting = 0
+
+        self.successes = 0
+        self.failures = 0
+        self.backoffs = 0
+        self.last_failure: str | None = None
+        self._backoff_at: float | None = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    async def acquire(self, owner: object = None, priority: int = 0) -> None:
+        """Wait for one token. Waiting owners are served in turn."""
+        self._refill()
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.add(owner, priority, fut)
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._waiting += 1
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._tokens += 1  # got the token just as we were cancelled — put it back
+            else:
+                fut.cancel()  # skipped when its turn comes
+            raise
+        finally:
+            self._waiting -= 1
+
+    async def _dispatch(self) -> None:
+        """Hand out tokens to waiters as they refill, until nobody is waiting."""
+        try:
+            while True:
+                self._refill()
+                while self._tokens >= 1:
+                    fut = self._waiters.pop()
+                    if fut is None:
+                        return
+                    self._tokens -= 1
+                    fut.set_result(None)
+                if not self._waiters:
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+        finally:
+            self._dispatcher = None
+
+    def record_success(self) -> None:
+        self.successes += 1
+        # +increase req/s per `rate` successes, i.e. per second at full speed
+        self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def record_failure(self, reason: str = "") -> None:
+        self.failures += 1
+        self.last_failure = reason or None
+        now = time.monotonic()
+        if self._backoff_at is not None and now - self._backoff_at < self.cooldown:
+            return
+        self._backoff_at = now
+        self.backoffs += 1
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self._tokens = min(self._tokens, 0.0)
+
+    def snapshot(self) -> dict:
+        """Current rate and backoff state, for monitoring."""
+        self._refill()
+        return {
+            "rate": round(self.rate, 2),
+            "min_rate": self.min_rate,
+            "max_rate": self.max_rate,
+            "tokens": round(self._tokens, 2),
+            "waiting": self._waiting,
+            "waiting_scans": self._waiters.owners,
+            "successes": self.successes,
+            "failures": self.failures,
+            "backoffs": self.backoffs,
+            "last_failure": self.last_failure,
+            "seconds_since_backoff": (
+                round(time.monotonic() - self._backoff_at, 1) if self._backoff_at is not None else None
+            ),
+        }
@@ -1,6 +1,9 @@
 """
 Scan Logger — persists every user scan to a local SQLite database.
 
+Same functions and record shape as scan_logger_supabase (see scan_record.py);
+the flat columns below are mapped to that shape on read.
+
 Table: scan_logs
 ──────────────────────────────────────────────────────────
 id              INTEGER PRIMARY KEY
@@ -20,20 +23,65 @@ platform        TEXT    (parsed: iOS / Android / Windows / macOS / Linux / Other
 latitude        REAL    (user geolocation, if provided)
 longitude       REAL    (user geolocation, if provided)
 results_json    TEXT    (full JSON dump of all results)
+fines_json      TEXT    (structured fines: totals + municipalities)
+aborted         INTEGER (1 if the client disconnected mid-scan)
+manufacturer    TEXT    (vehicle, set via update_scan_vehicle)
+model           TEXT
+email           TEXT    (subscriber, set via update_scan_subscriber)
+first_name      TEXT
+last_name       TEXT
+timings_json    TEXT    (per-step timings, debug scans only)
+──────────────────────────────────────────────────────────
+
+Table: subscribers
 ──────────────────────────────────────────────────────────
+id              INTEGER PRIMARY KEY
+created_at      TEXT    (ISO 8601, UTC)
+email           TEXT    NOT NULL UNIQUE
+first_name      TEXT
+last_name       TEXT
+──────────────────────────────────────────────────────────
+
+Tables: scan_stats (single row) + scan_cars (distinct car numbers)
+    Running totals for get_stats(), updated in the same transaction as each
+    insert, so stats are a single-row read at any table size.
+
+Concurrency: the database runs in WAL mode. Reads use one long-lived
+connection per thread; every write goes through a single writer thread that
+commits whatever is queued in one transaction, so concurrent scans never
+fight over the write lock ("database is locked"). A batch that fails anyway
+(e.g. the file is locked from outside for longer than busy_timeout) fails only
+its own writes, and callers wait at most LOG_WRITE_TIMEOUT for theirs.
+log_scan() returns the new row's id immediately — ids are allocated
+in-process, which assumes a single server process owns the database file.
+
+Environment variables:
+    SCAN_LOG_DB_PATH  — database file (default: scan_logs.db next to this file)
+    LOG_BATCH_SIZE    — max writes committed per transaction (default 50)
+    LOG_WRITE_TIMEOUT — seconds a caller waits for its write to commit (default 30)
 """
 
 import sqlite3
 import json
+import logging
 import os
-import re
+import queue
+import threading
+from concurrent.futures import Future
 from datetime import datetime, timezone
 from contextlib import contextmanager
+from functools import partial
+
+from scan_record import build_fines, build_scan_record, merge_results
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "scan_logs.db")
+DB_PATH = os.environ.get("SCAN_LOG_DB_PATH") or os.path.join(os.path.dirname(__file__), "scan_logs.db")
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", "50"))
+WRITE_TIMEOUT = float(os.environ.get("LOG_WRITE_TIMEOUT", "30"))
+
+logger = logging.getLogger(__name__)
 
 # ─── Schema version: bump when adding columns ────────────
-_CURRENT_SCHEMA_VERSION = 2
+_CURRENT_SCHEMA_VERSION = 5
 
 _NEW_COLUMNS = [
     # (column_name, column_def)
@@ -43,12 +91,23 @@ _NEW_COLUMNS = [
     ("platform", "TEXT"),
     ("latitude", "REAL"),
     ("longitude", "REAL"),
+    # v3
+    ("fines_json", "TEXT"),
+    ("aborted", "INTEGER DEFAULT 0"),
+    ("manufacturer", "TEXT"),
+    ("model", "TEXT"),
+    ("email", "TEXT"),
+    ("first_name", "TEXT"),
+    ("last_name", "TEXT"),
+    # v5
+    ("timings_json", "TEXT"),
 ]
 
 
 def _init_db():
     """Create the scan_logs table if it doesn't exist, and migrate."""
-    with _get_conn() as conn:
+    conn = _connect()
+    try:
         conn.execute("""
             CREATE TABLE IF NOT EXISTS scan_logs (
                 id              INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -75,37 +134,144 @@ def _init_db():
         for col_name, col_type in _NEW_COLUMNS:
             if col_name not in existing:
                 conn.execute(f"ALTER TABLE scan_logs ADD COLUMN {col_name} {col_type}")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS subscribers (
+                id              INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at      TEXT    NOT NULL,
+                email           TEXT    NOT NULL UNIQUE,
+                first_name      TEXT,
+                last_name       TEXT
+            )
+        """)
+        # v4: indexes + incremental stats
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_scan_logs_car_number ON scan_logs (car_number)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_scan_logs_timestamp ON scan_logs (timestamp)")
+        conn.execute("CREATE TABLE IF NOT EXISTS scan_cars (car_number TEXT PRIMARY KEY) WITHOUT ROWID")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS scan_stats (
+                id                  INTEGER PRIMARY KEY CHECK (id = 1),
+                total_scans         INTEGER NOT NULL,
+                unique_cars         INTEGER NOT NULL,
+                total_with_fines    INTEGER NOT NULL,
+                total_fine_items    INTEGER NOT NULL
+            )
+        """)
+        if conn.execute("SELECT 1 FROM scan_stats").fetchone() is None:
+            # One-time backfill from existing rows
+            conn.execute("""
+                INSERT OR IGNORE INTO scan_cars (car_number)
+                SELECT DISTINCT car_number FROM scan_logs WHERE car_number IS NOT NULL
+            """)
+            conn.execute("""
+                INSERT INTO scan_stats
+                SELECT 1,
+                       COUNT(*),
+                       (SELECT COUNT(*) FROM scan_cars),
+                       COALESCE(SUM(fine > 0), 0),
+                       COALESCE(SUM(total_fines), 0)
+                FROM scan_logs
+            """)
         conn.commit()
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM scan_logs").fetchone()[0]
+    finally:
+        conn.close()
 
 
-@contextmanager
-def _get_conn():
+def _connect() -> sqlite3.Connection:
     conn = sqlite3.connect(DB_PATH, timeout=10)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")     # readers never block the writer
+    conn.execute("PRAGMA synchronous = NORMAL")   # fsync at checkpoints only; safe with WAL
+    conn.execute("PRAGMA busy_timeout = 10000")
+    conn.execute("PRAGMA cache_size = -16000")    # 16 MB page cache
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+_local = threading.local()
+
+
+@contextmanager
+def _get_conn():
+    """This thread's long-lived read connection."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = _connect()
+    yield conn
+
+
+# ─── Writer thread ───────────────────────────────────────
+_queue: queue.Queue = queue.Queue()
+_STOP = object()
+_pending: dict[int, Future] = {}  # scan id -> insert not yet committed
+_pending_lock = threading.Lock()
+
+
+def _submit(op) -> Future:
+    """Queue op(conn) for the writer thread; the Future resolves once it is committed."""
+    fut: Future = Future()
+    _queue.put((op, fut))
+    return fut
+
+
+def _commit_batch(conn: sqlite3.Connection, batch: list) -> None:
+    outcomes = []
     try:
-        yield conn
-    finally:
-        conn.close()
+        conn.execute("BEGIN IMMEDIATE")
+        for op, fut in batch:
+            # A savepoint per write: one failing write doesn't roll back the others
+            conn.execute("SAVEPOINT write")
+            try:
+                outcomes.append((fut, op(conn), None))
+                conn.execute("RELEASE write")
+            except Exception as e:
+                conn.execute("ROLLBACK TO write")
+                conn.execute("RELEASE write")
+                outcomes.append((fut, None, e))
+        conn.execute("COMMIT")
+    except Exception as e:
+        # Locked database, failed commit, ...: this batch fails, the writer carries on
+        logger.exception("scan log batch of %d writes failed", len(batch))
+        if conn.in_transaction:
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+        outcomes = [(fut, None, e) for _, fut in batch]
+    for fut, result, error in outcomes:
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(result)
 
 
-def _parse_platform(ua: str) -> str:
-    """Extract a human-friendly platform name from a User-Agent string."""
-    if not ua:
-        return "Unknown"
-    ua_lower = ua.lower()
-    if "iphone" in ua_lower or "ipad" in ua_lower:
-        return "iOS"
-    if "android" in ua_lower:
-        return "Android"
-    if "macintosh" in ua_lower or "mac os" in ua_lower:
-        return "macOS"
-    if "windows" in ua_lower:
-        return "Windows"
-    if "linux" in ua_lower:
-        return "Linux"
-    if "cros" in ua_lower:
-        return "ChromeOS"
-    return "Other"
+def _writer() -> None:
+    conn = _connect()
+    conn.isolation_level = None  # transactions are managed in _commit_batch
+    stopping = False
+    while not stopping:
+        item = _queue.get()
+        if item is _STOP:
+            break
+        # Everything queued right now goes into the same transaction
+        batch = [item]
+        while len(batch) < LOG_BATCH_SIZE:
+            try:
+                item = _queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                stopping = True
+                break
+            batch.append(item)
+        _commit_batch(conn, batch)
+    conn.close()
+
+
+def close(timeout: float = 10.0) -> None:
+    """Commit queued writes and stop the writer thread."""
+    _queue.put(_STOP)
+    _writer_thread.join(timeout)
 
 
 def log_scan(
@@ -117,84 +283,303 @@ def log_scan(
     user_agent: str = "",
     latitude: float | None = None,
     longitude: float | None = None,
+    aborted: bool = False,
+    timings: dict | None = None,
 ):
-    """Log a completed scan to the database."""
-    # Calculate totals + collect fine details
-    total_fines = 0
-    total_amount = 0.0
+    """Queue a scan for the writer thread; returns its id right away."""
+    global _next_id
+    record = build_scan_record(ip, id_number, car_number, results, summary,
+                               user_agent, latitude, longitude, aborted, timings)
+    fines = record["fines"]
+    meta = record["check_metadata"]
+
+    with _pending_lock:
+        _next_id += 1
+        scan_id = _next_id
+    row = (
+        scan_id,
+        meta["timestamp"],
+        meta["ip"],
+        record["user_info"]["id_number"],
+        record["vehicle"]["car_number"],
+        *_fines_columns(fines),
+        user_agent,
+        meta["platform"],
+        latitude,
+        longitude,
+        json.dumps(results, ensure_ascii=False),
+        json.dumps(fines, ensure_ascii=False),
+        1 if aborted else 0,
+        json.dumps(timings, ensure_ascii=False) if timings else None,
+    )
+    fut = _submit(partial(_insert_scan, row=row))
+    with _pending_lock:
+        _pending[scan_id] = fut
+    fut.add_done_callback(partial(_insert_done, scan_id))
+    return scan_id
+
+
+def _fines_columns(fines: dict) -> tuple:
+    """clean, fine, failed, total_fines, total_amount, fine_munis, fine_addresses."""
+    # Flat columns for ad-hoc SQL: municipality names + fine addresses
     fine_munis: list[str] = []
     fine_addresses: list[str] = []
+    for muni in fines["municipalities"]:
+        fine_munis.append(muni["name"])
+        for f in muni.get("fines", []):
+            loc = f.get("location", "")
+            if loc:
+                fine_addresses.append(f"{muni['name']}: {loc}")
+    return (
+        fines["clean_count"],
+        fines["fine_count"],
+        fines["failed_count"],
+        fines["total_fines"],
+        f"{fines['total_amount']:.2f}" if fines["total_amount"] > 0 else "",
+        ", ".join(fine_munis),
+        " | ".join(fine_addresses),
+    )
 
-    for r in results:
-        if r.get("status") == "fine":
-            total_fines += r.get("count", 0)
-            fine_munis.append(r.get("name", ""))
-            try:
-                total_amount += float(r.get("amount", 0))
-            except (ValueError, TypeError):
-                pass
-            # Collect addresses from individual fines
-            for f in r.get("fines", []):
-                loc = f.get("location", "")
-                if loc:
-                    fine_addresses.append(f"{r.get('name', '')}: {loc}")
 
-    with _get_conn() as conn:
-        conn.execute(
-            """
-            INSERT INTO scan_logs
-                (timestamp, ip, id_number, car_number,
+def _insert_done(scan_id: int, fut: Future) -> None:
+    with _pending_lock:
+        _pending.pop(scan_id, None)
+    error = fut.exception()
+    if error is not None:
+        logger.error("scan log insert failed (id=%s)", scan_id, exc_info=error)
+
+
+def _insert_scan(conn: sqlite3.Connection, row: tuple) -> None:
+    """Writer-thread op: insert one scan and bump the running stats."""
+    conn.execute(
+        """
+        INSERT INTO scan_logs
+            (id, timestamp, ip, id_number, car_number,
                  clean, fine, failed, total_fines, total_amount,
                  fine_munis, fine_addresses,
                  user_agent, platform, latitude, longitude,
-                 results_json)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                 results_json, fines_json, aborted, timings_json)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        row,
+    )
+    new_car = conn.execute(
+        "INSERT OR IGNORE INTO scan_cars (car_number) VALUES (?)", (row[4],),
+    ).rowcount
+    conn.execute(
+        """
+        UPDATE scan_stats SET
+            total_scans = total_scans + 1,
+            unique_cars = unique_cars + ?,
+            total_with_fines = total_with_fines + ?,
+            total_fine_items = total_fine_items + ?
+        WHERE id = 1
+        """,
+        (new_car, 1 if row[6] > 0 else 0, row[8]),
+    )
+
+
+def _row_to_log(row: sqlite3.Row, raw_results: list | None = None) -> dict:
+    """Map a flat scan_logs row to the structured record shape."""
+    if row["fines_json"]:
+        fines = json.loads(row["fines_json"])
+    else:
+        # Rows from before v3 only have the raw results
+        legacy = row["results_json"] if "results_json" in row.keys() else row["legacy_results"]
+        fines = build_fines(json.loads(legacy or "[]"), {
+            "clean": row["clean"], "fine": row["fine"], "failed": row["failed"],
+        })
+
+    vehicle = {"car_number": row["car_number"]}
+    if row["manufacturer"] is not None or row["model"] is not None:
+        vehicle["manufacturer"] = row["manufacturer"] or ""
+        vehicle["model"] = row["model"] or ""
+
+    user_info = {"id_number": row["id_number"]}
+    if row["email"] is not None:
+        user_info["email"] = row["email"]
+        user_info["first_name"] = row["first_name"] or ""
+        user_info["last_name"] = row["last_name"] or ""
+
+    location = None
+    if row["latitude"] is not None and row["longitude"] is not None:
+        location = {"latitude": row["latitude"], "longitude": row["longitude"]}
+    check_metadata = {
+        "timestamp": row["timestamp"],
+        "ip": row["ip"],
+        "platform": row["platform"],
+        "user_agent": row["user_agent"],
+        "location": location,
+    }
+    if raw_results is not None:
+        check_metadata["raw_results"] = raw_results
+    if row["aborted"]:
+        check_metadata["aborted"] = True
+    if "timings_json" in row.keys() and row["timings_json"]:
+        check_metadata["timings"] = json.loads(row["timings_json"])
+
+    return {
+        "id": row["id"],
+        "created_at": row["timestamp"],
+        "vehicle": vehicle,
+        "user_info": user_info,
+        "fines": fines,
+        "check_metadata": check_metadata,
+    }
+
+
+# List view columns: everything but results_json, which is only read for
+# legacy rows that have no fines_json to show
+_LIST_COLUMNS = """
+    id, timestamp, ip, id_number, car_number, clean, fine, failed,
+    user_agent, platform, latitude, longitude, fines_json, aborted,
+    manufacturer, model, email, first_name, last_name,
+    CASE WHEN fines_json IS NULL THEN results_json END AS legacy_results
+"""
+
+
+def get_logs(limit: int = 100, offset: int = 0, before_id: int | None = None) -> list[dict]:
+    """Return recent scan logs, newest first, without check_metadata.raw_results.
+
+    Pass the last id of the previous page as before_id for keyset pagination.
+    """
+    with _get_conn() as conn:
+        if before_id is not None:
+            rows = conn.execute(
+                f"SELECT {_LIST_COLUMNS} FROM scan_logs WHERE id < ? ORDER BY id DESC LIMIT ?",
+                (before_id, limit),
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                f"SELECT {_LIST_COLUMNS} FROM scan_logs ORDER BY id DESC LIMIT ? OFFSET ?",
+                (limit, offset),
+            ).fetchall()
+        return [_row_to_log(r) for r in rows]
+
+
+def get_log_by_id(log_id: int) -> dict | None:
+    """Return a single scan log by ID."""
+    with _pending_lock:
+        fut = _pending.get(log_id)
+    if fut is not None:
+        try:
+            fut.exception(timeout=WRITE_TIMEOUT)  # just logged — wait until it is committed
+        except TimeoutError:
+            pass  # writer is stuck; read whatever is there
+    with _get_conn() as conn:
+        row = conn.execute("SELECT * FROM scan_logs WHERE id = ?", (log_id,)).fetchone()
+        if row is None:
+            return None
+        return _row_to_log(row, raw_results=json.loads(row["results_json"] or "[]"))
+
+
+def update_scan_subscriber(
+    scan_id: int,
+    email: str,
+    first_name: str = "",
+    last_name: str = "",
+) -> dict | None:
+    """Set subscriber info on a scan log row; returns the merged user_info."""
+    def op(conn):
+        row = conn.execute(
+            """
+            UPDATE scan_logs SET email = ?, first_name = ?, last_name = ?
+            WHERE id = ?
+            RETURNING id_number, email, first_name, last_name
             """,
             (
-                datetime.now(timezone.utc).isoformat(),
-                ip or "",
-                id_number.strip(),
-                car_number.strip(),
-                summary.get("clean", 0),
-                summary.get("fine", 0),
-                summary.get("failed", 0),
-                total_fines,
-                f"{total_amount:.2f}" if total_amount > 0 else "",
-                ", ".join(fine_munis) if fine_munis else "",
-                " | ".join(fine_addresses) if fine_addresses else "",
-                user_agent,
-                _parse_platform(user_agent),
-                latitude,
-                longitude,
-                json.dumps(results, ensure_ascii=False),
+                email.strip().lower(),
+                first_name.strip() if first_name else "",
+                last_name.strip() if last_name else "",
+                scan_id,
             ),
+        ).fetchone()
+        return dict(row) if row else None
+    return _submit(op).result(timeout=WRITE_TIMEOUT)
+
+
+def update_scan_vehicle(
+    scan_id: int,
+    manufacturer: str = "",
+    model: str = "",
+) -> dict | None:
+    """Set vehicle manufacturer & model on a scan log row; returns the merged vehicle."""
+    def op(conn):
+        row = conn.execute(
+            """
+            UPDATE scan_logs SET manufacturer = ?, model = ?
+            WHERE id = ?
+            RETURNING car_number, manufacturer, model
+            """,
+            (
+                manufacturer.strip() if manufacturer else "",
+                model.strip() if model else "",
+                scan_id,
+            ),
+        ).fetchone()
+        return dict(row) if row else None
+    return _submit(op).result(timeout=WRITE_TIMEOUT)
+
+
+def update_scan_results(scan_id: int, results: list[dict]) -> dict | None:
+    """Merge re-checked municipalities into a scan's results; returns the rebuilt fines."""
+    def op(conn):
+        row = conn.execute(
+            "SELECT results_json, fine, total_fines FROM scan_logs WHERE id = ?", (scan_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        merged, fines = merge_results(json.loads(row["results_json"] or "[]"), results)
+        conn.execute(
+            """
+            UPDATE scan_logs SET
+                clean = ?, fine = ?, failed = ?, total_fines = ?, total_amount = ?,
+                fine_munis = ?, fine_addresses = ?, results_json = ?, fines_json = ?
+            WHERE id = ?
+            """,
+            (*_fines_columns(fines), json.dumps(merged, ensure_ascii=False),
+             json.dumps(fines, ensure_ascii=False), scan_id),
         )
-        conn.commit()
+        conn.execute(
+            """
+            UPDATE scan_stats SET
+                total_with_fines = total_with_fines + ?,
+                total_fine_items = total_fine_items + ?
+            WHERE id = 1
+            """,
+            ((fines["fine_count"] > 0) - (row["fine"] > 0), fines["total_fines"] - row["total_fines"]),
+        )
+        return fines
+    return _submit(op).result(timeout=WRITE_TIMEOUT)
 
 
-def get_logs(limit: int = 100, offset: int = 0) -> list[dict]:
-    """Return recent scan logs, newest first."""
-    with _get_conn() as conn:
-        rows = conn.execute(
-            "SELECT * FROM scan_logs ORDER BY id DESC LIMIT ? OFFSET ?",
-            (limit, offset),
-        ).fetchall()
-        return [dict(r) for r in rows]
+def save_subscriber(email: str, first_name: str = "", last_name: str = "") -> dict:
+    """Save a new newsletter subscriber. Raises sqlite3.IntegrityError (UNIQUE) on a duplicate email."""
+    row = {
+        "email": email.strip().lower(),
+        "first_name": first_name.strip() if first_name else "",
+        "last_name": last_name.strip() if last_name else "",
+    }
+    def op(conn):
+        cur = conn.execute(
+            "INSERT INTO subscribers (created_at, email, first_name, last_name) VALUES (?, ?, ?, ?)",
+            (datetime.now(timezone.utc).isoformat(), row["email"], row["first_name"], row["last_name"]),
+        )
+        return {"id": cur.lastrowid, **row}
+    return _submit(op).result(timeout=WRITE_TIMEOUT)
 
 
 def get_stats() -> dict:
-    """Return aggregate statistics."""
+    """Return aggregate statistics (kept up to date by every insert)."""
     with _get_conn() as conn:
         row = conn.execute("""
-            SELECT
-                COUNT(*)                    AS total_scans,
-                COUNT(DISTINCT car_number)  AS unique_cars,
-                SUM(fine)                   AS total_with_fines,
-                SUM(total_fines)            AS total_fine_items
-            FROM scan_logs
+            SELECT total_scans, unique_cars, total_with_fines, total_fine_items
+            FROM scan_stats WHERE id = 1
         """).fetchone()
         return dict(row)
 
 
 # Initialise DB on import
-_init_db()
+_next_id = _init_db()
+_writer_thread = threading.Thread(target=_writer, name="scan-log-writer", daemon=True)
+_writer_thread.start()
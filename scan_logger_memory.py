@@ -0,0 +1,178 @@
+"""
+Scan Logger — keeps scans in process memory (no database, no network).
+
+Meant for local development and load tests: same functions and record shape
+as scan_logger_supabase (see scan_record.py), but everything lives in this
+process and is gone on restart. Only the newest MEMORY_LOG_MAX scans are kept.
+
+Environment variables:
+    MEMORY_LOG_MAX  — max scans kept (default 10000)
+"""
+
+import bisect
+import copy
+import os
+import threading
+from datetime import datetime, timezone
+
+from scan_record import build_scan_record, merge_results
+
+MEMORY_LOG_MAX = int(os.environ.get("MEMORY_LOG_MAX", "10000"))
+
+_lock = threading.Lock()
+_ids: list[int] = []  # ascending, parallel to _rows
+_rows: list[dict] = []
+_next_id = 1
+_subscribers: dict[str, dict] = {}  # email -> row
+
+# Stats are kept incrementally, so get_stats() is constant time
+_total_scans = 0
+_car_numbers: set[str] = set()
+_total_with_fines = 0
+_total_fine_items = 0
+
+
+def log_scan(
+    ip: str,
+    id_number: str,
+    car_number: str,
+    results: list[dict],
+    summary: dict,
+    user_agent: str = "",
+    latitude: float | None = None,
+    longitude: float | None = None,
+    aborted: bool = False,
+    timings: dict | None = None,
+):
+    """Store a scan; returns its id."""
+    global _next_id, _total_scans, _total_with_fines, _total_fine_items
+    record = build_scan_record(ip, id_number, car_number, results, summary,
+                               user_agent, latitude, longitude, aborted, timings)
+    with _lock:
+        scan_id = _next_id
+        _next_id += 1
+        _ids.append(scan_id)
+        _rows.append({
+            "id": scan_id,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            **record,
+        })
+        if len(_rows) > MEMORY_LOG_MAX:
+            del _ids[0], _rows[0]
+
+        _total_scans += 1
+        _car_numbers.add(record["vehicle"]["car_number"])
+        if record["fines"]["fine_count"] > 0:
+            _total_with_fines += 1
+        _total_fine_items += record["fines"]["total_fines"]
+    return scan_id
+
+
+def _find(scan_id: int) -> dict | None:
+    i = bisect.bisect_left(_ids, scan_id)
+    if i < len(_ids) and _ids[i] == scan_id:
+        return _rows[i]
+    return None
+
+
+def _merge(scan_id: int, column: str, patch: dict) -> dict | None:
+    with _lock:
+        row = _find(scan_id)
+        if row is None:
+            return None
+        row[column] = {**(row.get(column) or {}), **patch}
+        return dict(row[column])
+
+
+def update_scan_subscriber(
+    scan_id: int,
+    email: str,
+    first_name: str = "",
+    last_name: str = "",
+) -> dict | None:
+    """Merge subscriber info into user_info; returns the merged value."""
+    return _merge(scan_id, "user_info", {
+        "email": email.strip().lower(),
+        "first_name": first_name.strip() if first_name else "",
+        "last_name": last_name.strip() if last_name else "",
+    })
+
+
+def update_scan_vehicle(
+    scan_id: int,
+    manufacturer: str = "",
+    model: str = "",
+) -> dict | None:
+    """Merge manufacturer & model into vehicle; returns the merged value."""
+    return _merge(scan_id, "vehicle", {
+        "manufacturer": manufacturer.strip() if manufacturer else "",
+        "model": model.strip() if model else "",
+    })
+
+
+def update_scan_results(scan_id: int, results: list[dict]) -> dict | None:
+    """Merge re-checked municipalities into a scan's raw_results; returns the rebuilt fines."""
+    global _total_with_fines, _total_fine_items
+    with _lock:
+        row = _find(scan_id)
+        if row is None:
+            return None
+        meta = row["check_metadata"]
+        old = row["fines"]
+        meta["raw_results"], row["fines"] = merge_results(meta.get("raw_results") or [], results)
+        _total_with_fines += (row["fines"]["fine_count"] > 0) - (old["fine_count"] > 0)
+        _total_fine_items += row["fines"]["total_fines"] - old["total_fines"]
+        return copy.deepcopy(row["fines"])
+
+
+def _list_view(row: dict) -> dict:
+    entry = copy.deepcopy({k: v for k, v in row.items() if k != "check_metadata"})
+    entry["check_metadata"] = {k: v for k, v in row["check_metadata"].items() if k not in ("raw_results", "timings")}
+    return entry
+
+
+def get_logs(limit: int = 100, offset: int = 0, before_id: int | None = None) -> list[dict]:
+    """Return recent scan logs, newest first, without check_metadata.raw_results / timings."""
+    with _lock:
+        end = bisect.bisect_left(_ids, before_id) if before_id is not None else len(_rows) - offset
+        start = max(0, end - limit)
+        page = _rows[start:max(0, end)]
+        return [_list_view(row) for row in reversed(page)]
+
+
+def get_log_by_id(log_id: int) -> dict | None:
+    """Return a single scan log by ID."""
+    with _lock:
+        row = _find(log_id)
+        return copy.deepcopy(row) if row is not None else None
+
+
+def save_subscriber(email: str, first_name: str = "", last_name: str = "") -> dict:
+    """Save a newsletter subscriber. Raises on a duplicate email, like the UNIQUE constraint."""
+    row = {
+        "email": email.strip().lower(),
+        "first_name": first_name.strip() if first_name else "",
+        "last_name": last_name.strip() if last_name else "",
+    }
+    with _lock:
+        if row["email"] in _subscribers:
+            raise ValueError(f"duplicate subscriber email: {row['email']}")
+        row["id"] = len(_subscribers) + 1
+        row["created_at"] = datetime.now(timezone.utc).isoformat()
+        _subscribers[row["email"]] = row
+    return dict(row)
+
+
+def get_stats() -> dict:
+    """Return aggregate statistics."""
+    with _lock:
+        return {
+            "total_scans": _total_scans,
+            "unique_cars": len(_car_numbers),
+            "total_with_fines": _total_with_fines,
+            "total_fine_items": _total_fine_items,
+        }
+
+
+def close() -> None:
+    """Nothing to flush — here for interface parity with the other backends."""
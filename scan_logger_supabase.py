@@ -16,12 +16,27 @@ check_metadata  JSONB  {timestamp, ip, platform, user_agent,
 Environment variables (set in .env or hosting platform):
     SUPABASE_URL          — project URL   (e.g. https://xxx.supabase.co)
     SUPABASE_SERVICE_KEY  — service_role secret key
+    LOG_BATCH_SIZE        — max rows per multi-row insert (default 50)
+    LOG_FLUSH_INTERVAL    — max seconds a logged scan waits before insert (default 1)
+    STATS_CACHE_TTL       — seconds before /scan-stats numbers are recomputed (default 60)
+
+SQL functions this module calls over RPC live in supabase/functions.sql.
+
+Scans are written behind: log_scan() assigns the row id client-side, queues
+the row and returns immediately; a writer thread inserts queued rows in
+batches. Call close() on shutdown to drain the queue.
 """
 
 import os
-from datetime import datetime, timezone
+import queue
+import random
+import threading
+import time
+import logging
 from supabase import create_client, Client
 
+from scan_record import build_scan_record, merge_results
+
 # ─── Supabase connection ─────────────────────────────────
 # In production: set via Railway dashboard environment variables.
 # In local dev:  create a .env file (already gitignored) with:
@@ -45,25 +60,139 @@ _supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 TABLE = "scan_logs"
 
-
-def _parse_platform(ua: str) -> str:
-    """Extract a human-friendly platform name from a User-Agent string."""
-    if not ua:
-        return "Unknown"
-    ua_lower = ua.lower()
-    if "iphone" in ua_lower or "ipad" in ua_lower:
-        return "iOS"
-    if "android" in ua_lower:
-        return "Android"
-    if "macintosh" in ua_lower or "mac os" in ua_lower:
-        return "macOS"
-    if "windows" in ua_lower:
-        return "Windows"
-    if "linux" in ua_lower:
-        return "Linux"
-    if "cros" in ua_lower:
-        return "ChromeOS"
-    return "Other"
+logger = logging.getLogger(__name__)
+
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", "50"))
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", "1"))
+
+
+# ─── Client-generated scan ids ───────────────────────────
+# id = centiseconds since 2024-01-01 << 16 | process node << 4 | sequence.
+# Sorts by creation time (newer rows above the old BIGSERIAL ids), stays below
+# 2^53 so it survives JSON → JavaScript numbers, and never touches the row
+# sequence. The 12-bit node is leased from the scan_log_node_seq sequence
+# (next_scan_log_node() in supabase/functions.sql), so processes alive at the
+# same time get distinct nodes unless 4096 others started in between. More
+# than 16 ids in one centisecond borrow the next centisecond, never the node.
+_ID_EPOCH = 1704067200
+_ID_NODE_BITS = 12
+_ID_SEQ_BITS = 4
+_id_lock = threading.Lock()
+_id_node: int | None = None
+_id_node_ready = threading.Event()
+_id_tick = 0
+_id_seq = 0
+
+
+def _lease_node() -> None:
+    """Lease this process's id node. Runs on the writer thread, so log_scan never waits on the network."""
+    global _id_node
+    try:
+        node = int(_supabase.rpc("next_scan_log_node", {}).execute().data) % (1 << _ID_NODE_BITS)
+    except Exception:
+        # Ids may now collide with another process's: run supabase/functions.sql
+        logger.exception("next_scan_log_node() failed, using a random scan id node")
+        node = random.randrange(1 << _ID_NODE_BITS)
+    with _id_lock:
+        if _id_node is None:
+            _id_node = node
+    _id_node_ready.set()
+
+
+def _new_scan_id() -> int:
+    global _id_node, _id_tick, _id_seq
+    if _id_node is None:
+        _id_node_ready.wait(timeout=5)  # only scans logged right after startup
+    with _id_lock:
+        if _id_node is None:
+            logger.error("scan id node not leased yet, using a random one")
+            _id_node = random.randrange(1 << _ID_NODE_BITS)
+        tick = int((time.time() - _ID_EPOCH) * 100)
+        if tick <= _id_tick:
+            tick, seq = _id_tick, _id_seq + 1
+            if seq >> _ID_SEQ_BITS:
+                tick, seq = tick + 1, 0
+        else:
+            seq = 0
+        _id_tick, _id_seq = tick, seq
+        return (tick << (_ID_NODE_BITS + _ID_SEQ_BITS)) | (_id_node << _ID_SEQ_BITS) | seq
+
+
+# ─── Write-behind queue ──────────────────────────────────
+_queue: queue.Queue = queue.Queue()
+_pending: set[int] = set()  # ids queued or being inserted
+_pending_cond = threading.Condition()
+_STOP = object()
+
+
+def _insert_batch(rows: list[dict]) -> None:
+    try:
+        _supabase.table(TABLE).insert(rows).execute()
+        return
+    except Exception:
+        if len(rows) == 1:
+            logger.exception("scan log insert failed (id=%s)", rows[0].get("id"))
+            return
+    # One bad row shouldn't lose the rest of the batch
+    for row in rows:
+        _insert_batch([row])
+
+
+def _writer() -> None:
+    _lease_node()
+    stopping = False
+    while not stopping:
+        item = _queue.get()
+        if item is _STOP:
+            break
+        batch = [item]
+        deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+        while len(batch) < LOG_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = _queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                stopping = True
+                break
+            batch.append(item)
+        _insert_batch(batch)
+        with _pending_cond:
+            _pending.difference_update(row["id"] for row in batch)
+            _pending_cond.notify_all()
+    # Drain whatever was queued behind the stop marker
+    leftover = []
+    while True:
+        try:
+            item = _queue.get_nowait()
+        except queue.Empty:
+            break
+        if item is not _STOP:
+            leftover.append(item)
+    for i in range(0, len(leftover), LOG_BATCH_SIZE):
+        _insert_batch(leftover[i:i + LOG_BATCH_SIZE])
+    with _pending_cond:
+        _pending.clear()
+        _pending_cond.notify_all()
+
+
+_writer_thread = threading.Thread(target=_writer, name="scan-log-writer", daemon=True)
+_writer_thread.start()
+
+
+def _wait_written(scan_id: int, timeout: float = 5.0) -> None:
+    """Block until a queued scan row has been inserted (or timeout)."""
+    with _pending_cond:
+        _pending_cond.wait_for(lambda: scan_id not in _pending, timeout=timeout)
+
+
+def close(timeout: float = 10.0) -> None:
+    """Flush queued scan logs and stop the writer thread."""
+    _queue.put(_STOP)
+    _writer_thread.join(timeout)
 
 
 def log_scan(
@@ -75,77 +204,45 @@ def log_scan(
     user_agent: str = "",
     latitude: float | None = None,
     longitude: float | None = None,
+    aborted: bool = False,
+    timings: dict | None = None,
 ):
-    """Log a completed scan to Supabase with structured JSONB columns."""
-    # ── Build municipalities list for fines ──
-    municipalities: list[dict] = []
-    total_fines = 0
-    total_amount = 0.0
-
-    for r in results:
-        if r.get("status") == "fine":
-            total_fines += r.get("count", 0)
-            try:
-                total_amount += float(r.get("amount", 0))
-            except (ValueError, TypeError):
-                pass
-            muni: dict = {
-                "name": r.get("name", ""),
-                "count": r.get("count", 0),
-            }
-            if r.get("fines"):
-                muni["fines"] = r["fines"]
-            if r.get("payment_url"):
-                muni["payment_url"] = r["payment_url"]
-            if r.get("person_name"):
-                muni["person_name"] = r["person_name"]
-            municipalities.append(muni)
-
-    # ── vehicle ──
-    vehicle = {
-        "car_number": car_number.strip(),
-    }
+    """Queue a scan for insert into Supabase; returns its id immediately.
 
-    # ── user_info ──
-    user_info = {
-        "id_number": id_number.strip(),
+    aborted=True marks a partial scan whose client disconnected before it finished;
+    timings (per-municipality step breakdown) is stored in check_metadata.
+    """
+    scan_id = _new_scan_id()
+    row = {
+        "id": scan_id,
+        **build_scan_record(ip, id_number, car_number, results, summary,
+                            user_agent, latitude, longitude, aborted, timings),
     }
 
-    # ── fines ──
-    fines = {
-        "total_fines": total_fines,
-        "total_amount": total_amount if total_amount > 0 else 0,
-        "clean_count": summary.get("clean", 0),
-        "fine_count": summary.get("fine", 0),
-        "failed_count": summary.get("failed", 0),
-        "municipalities": municipalities,
-    }
+    with _pending_cond:
+        _pending.add(scan_id)
+    _queue.put(row)
+    return scan_id
 
-    # ── check_metadata ──
-    location = None
-    if latitude is not None and longitude is not None:
-        location = {"latitude": latitude, "longitude": longitude}
-
-    check_metadata = {
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "ip": ip or "",
-        "platform": _parse_platform(user_agent),
-        "user_agent": user_agent,
-        "location": location,
-        "raw_results": results,
-    }
 
-    row = {
-        "vehicle": vehicle,
-        "user_info": user_info,
-        "fines": fines,
-        "check_metadata": check_metadata,
-    }
+def _merge_jsonb(scan_id: int, column: str, patch: dict) -> dict | None:
+    """Merge patch into a JSONB column of one row, server-side in one round trip.
+
+    Uses the merge_scan_<column>() functions from supabase/functions.sql; while
+    those are missing, falls back to a (non-atomic) read-modify-write.
+    """
+    try:
+        return _supabase.rpc(f"merge_scan_{column}", {"scan_id": scan_id, "patch": patch}).execute().data
+    except Exception as e:
+        if getattr(e, "code", None) != "PGRST202":  # PostgREST: function not found
+            raise
+        logger.warning("merge_scan_%s() RPC missing, falling back to read-modify-write", column)
 
-    result = _supabase.table(TABLE).insert(row).execute()
-    if result.data:
-        return result.data[0].get("id")
-    return None
+    current = _supabase.table(TABLE).select(column).eq("id", scan_id).execute()
+    value = (current.data[0].get(column) or {}) if current.data else {}
+    value.update(patch)
+    result = _supabase.table(TABLE).update({column: value}).eq("id", scan_id).execute()
+    return result.data[0].get(column) if result.data else None
 
 
 def update_scan_subscriber(
@@ -154,21 +251,16 @@ def update_scan_subscriber(
     first_name: str = "",
     last_name: str = "",
 ) -> dict | None:
-    """Merge subscriber info into the user_info JSONB of a scan log row."""
-    # Read current user_info to preserve id_number
-    current = _supabase.table(TABLE).select("user_info").eq("id", scan_id).execute()
-    user_info = current.data[0].get("user_info", {}) if current.data else {}
-    user_info["email"] = email.strip().lower()
-    user_info["first_name"] = first_name.strip() if first_name else ""
-    user_info["last_name"] = last_name.strip() if last_name else ""
+    """Merge subscriber info into the user_info JSONB of a scan log row.
 
-    result = (
-        _supabase.table(TABLE)
-        .update({"user_info": user_info})
-        .eq("id", scan_id)
-        .execute()
-    )
-    return result.data[0] if result.data else None
+    Returns the merged user_info, or None if the row doesn't exist.
+    """
+    _wait_written(scan_id)
+    return _merge_jsonb(scan_id, "user_info", {
+        "email": email.strip().lower(),
+        "first_name": first_name.strip() if first_name else "",
+        "last_name": last_name.strip() if last_name else "",
+    })
 
 
 def update_scan_vehicle(
@@ -176,36 +268,64 @@ def update_scan_vehicle(
     manufacturer: str = "",
     model: str = "",
 ) -> dict | None:
-    """Merge vehicle manufacturer & model into the vehicle JSONB."""
-    # Read current vehicle to preserve car_number
-    current = _supabase.table(TABLE).select("vehicle").eq("id", scan_id).execute()
-    vehicle = current.data[0].get("vehicle", {}) if current.data else {}
-    vehicle["manufacturer"] = manufacturer.strip() if manufacturer else ""
-    vehicle["model"] = model.strip() if model else ""
+    """Merge vehicle manufacturer & model into the vehicle JSONB.
 
-    result = (
-        _supabase.table(TABLE)
-        .update({"vehicle": vehicle})
-        .eq("id", scan_id)
-        .execute()
-    )
-    return result.data[0] if result.data else None
+    Returns the merged vehicle, or None if the row doesn't exist.
+    """
+    _wait_written(scan_id)
+    return _merge_jsonb(scan_id, "vehicle", {
+        "manufacturer": manufacturer.strip() if manufacturer else "",
+        "model": model.strip() if model else "",
+    })
 
 
-def get_logs(limit: int = 100, offset: int = 0) -> list[dict]:
-    """Return recent scan logs, newest first."""
-    result = (
-        _supabase.table(TABLE)
-        .select("*")
-        .order("id", desc=True)
-        .range(offset, offset + limit - 1)
-        .execute()
-    )
-    return result.data
+def update_scan_results(scan_id: int, results: list[dict]) -> dict | None:
+    """Merge re-checked municipalities into check_metadata.raw_results and rebuild fines.
+
+    A read-modify-write: the merge needs build_fines(), which lives here, not in SQL.
+    Returns the rebuilt fines, or None if the row doesn't exist.
+    """
+    _wait_written(scan_id)
+    current = _supabase.table(TABLE).select("check_metadata").eq("id", scan_id).execute()
+    if not current.data:
+        return None
+    meta = current.data[0].get("check_metadata") or {}
+    meta["raw_results"], fines = merge_results(meta.get("raw_results") or [], results)
+    _supabase.table(TABLE).update({"check_metadata": meta, "fines": fines}).eq("id", scan_id).execute()
+    return fines
+
+
+# check_metadata keys returned by the list view — everything except raw_results
+_LIST_META_KEYS = ("timestamp", "ip", "platform", "user_agent", "location", "aborted")
+_LIST_COLUMNS = ", ".join(
+    ["id", "created_at", "vehicle", "user_info", "fines"]
+    + [f"meta_{k}:check_metadata->{k}" for k in _LIST_META_KEYS]
+)
+
+
+def get_logs(limit: int = 100, offset: int = 0, before_id: int | None = None) -> list[dict]:
+    """Return recent scan logs, newest first, without check_metadata.raw_results.
+
+    Pass the last id of the previous page as before_id for keyset pagination
+    (constant cost at any depth); offset is kept for older callers.
+    """
+    query = _supabase.table(TABLE).select(_LIST_COLUMNS).order("id", desc=True)
+    if before_id is not None:
+        query = query.lt("id", before_id).limit(limit)
+    else:
+        query = query.range(offset, offset + limit - 1)
+    rows = query.execute().data
+    for row in rows:
+        meta = {k: row.pop(f"meta_{k}", None) for k in _LIST_META_KEYS}
+        if not meta["aborted"]:
+            meta.pop("aborted")
+        row["check_metadata"] = meta
+    return rows
 
 
 def get_log_by_id(log_id: int) -> dict | None:
     """Return a single scan log by ID."""
+    _wait_written(log_id)
     result = (
         _supabase.table(TABLE)
         .select("*")
@@ -239,8 +359,32 @@ def save_subscriber(email: str, first_name: str = "", last_name: str = "") -> di
     return result.data[0] if result.data else row
 
 
-def get_stats() -> dict:
-    """Return aggregate statistics."""
+STATS_CACHE_TTL = float(os.environ.get("STATS_CACHE_TTL", "60"))
+
+_stats_snapshot: dict | None = None
+_stats_at = 0.0
+_stats_lock = threading.Lock()
+_stats_refreshing = False
+
+
+def _compute_stats() -> dict:
+    """One server-side aggregate (see supabase/functions.sql)."""
+    try:
+        result = _supabase.rpc("scan_stats").execute()
+        data = result.data[0] if isinstance(result.data, list) else result.data
+        return {
+            "total_scans": int(data.get("total_scans") or 0),
+            "unique_cars": int(data.get("unique_cars") or 0),
+            "total_with_fines": int(data.get("total_with_fines") or 0),
+            "total_fine_items": int(data.get("total_fine_items") or 0),
+        }
+    except Exception:
+        logger.warning("scan_stats() RPC unavailable, aggregating client-side", exc_info=True)
+        return _compute_stats_client_side()
+
+
+def _compute_stats_client_side() -> dict:
+    """Fallback for databases without the scan_stats() function."""
     all_rows = _supabase.table(TABLE).select("id, vehicle, fines", count="exact").execute()
     total_scans = all_rows.count or 0
 
@@ -261,3 +405,32 @@ def get_stats() -> dict:
         "total_with_fines": total_with_fines,
         "total_fine_items": total_fine_items,
     }
+
+
+def _refresh_stats() -> None:
+    global _stats_snapshot, _stats_at, _stats_refreshing
+    try:
+        snapshot = _compute_stats()
+        with _stats_lock:
+            _stats_snapshot, _stats_at = snapshot, time.monotonic()
+    finally:
+        _stats_refreshing = False
+
+
+def get_stats() -> dict:
+    """Return aggregate statistics.
+
+    Served from a cached snapshot; once it is older than STATS_CACHE_TTL it is
+    recomputed in the background while the old numbers keep being served.
+    """
+    global _stats_refreshing
+    with _stats_lock:
+        snapshot = _stats_snapshot
+        stale = time.monotonic() - _stats_at > STATS_CACHE_TTL
+        if snapshot is not None and stale and not _stats_refreshing:
+            _stats_refreshing = True
+            threading.Thread(target=_refresh_stats, name="scan-stats-refresh", daemon=True).start()
+    if snapshot is None:
+        _refresh_stats()
+        snapshot = _stats_snapshot
+    return dict(snapshot)
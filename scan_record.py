@@ -0,0 +1,142 @@
+"""
+Scan record — the structured shape every scan log backend stores and returns.
+
+Record (one per scan)
+──────────────────────────────────────────────────────────
+id              integer
+created_at      ISO 8601 timestamp
+vehicle         {car_number, manufacturer, model}
+user_info       {id_number, first_name, last_name, email}
+fines           {total_fines, total_amount, clean_count, fine_count,
+                 failed_count, municipalities: [...]}
+check_metadata  {timestamp, ip, platform, user_agent,
+                 location: {latitude, longitude}, raw_results: [...],
+                 aborted (only on partial scans),
+                 timings: {rashut: {step: ms}} (only on debug scans)}
+──────────────────────────────────────────────────────────
+"""
+
+from datetime import datetime, timezone
+
+
+def parse_platform(ua: str) -> str:
+    """Extract a human-friendly platform name from a User-Agent string."""
+    if not ua:
+        return "Unknown"
+    ua_lower = ua.lower()
+    if "iphone" in ua_lower or "ipad" in ua_lower:
+        return "iOS"
+    if "android" in ua_lower:
+        return "Android"
+    if "macintosh" in ua_lower or "mac os" in ua_lower:
+        return "macOS"
+    if "windows" in ua_lower:
+        return "Windows"
+    if "linux" in ua_lower:
+        return "Linux"
+    if "cros" in ua_lower:
+        return "ChromeOS"
+    return "Other"
+
+
+def build_fines(results: list[dict], summary: dict) -> dict:
+    """The fines column: totals plus one entry per municipality with fines."""
+    municipalities: list[dict] = []
+    total_fines = 0
+    total_amount = 0.0
+
+    for r in results:
+        if r.get("status") == "fine":
+            total_fines += r.get("count", 0)
+            try:
+                total_amount += float(r.get("amount", 0))
+            except (ValueError, TypeError):
+                pass
+            muni: dict = {
+                "name": r.get("name", ""),
+                "count": r.get("count", 0),
+            }
+            if r.get("fines"):
+                muni["fines"] = r["fines"]
+            if r.get("payment_url"):
+                muni["payment_url"] = r["payment_url"]
+            if r.get("person_name"):
+                muni["person_name"] = r["person_name"]
+            municipalities.append(muni)
+
+    return {
+        "total_fines": total_fines,
+        "total_amount": total_amount if total_amount > 0 else 0,
+        "clean_count": summary.get("clean", 0),
+        "fine_count": summary.get("fine", 0),
+        "failed_count": summary.get("failed", 0),
+        "municipalities": municipalities,
+    }
+
+
+def merge_results(results: list[dict], updates: list[dict]) -> tuple[list[dict], dict]:
+    """Replace municipalities in results with their entries from updates; returns
+    the merged results and their rebuilt fines column.
+
+    Entries are matched by rashut (names are not unique). Rows logged before
+    results carried a rashut are matched by name, in order.
+    """
+    by_rashut = {r["rashut"]: r for r in updates if r.get("rashut")}
+    by_name: dict[str, list[dict]] = {}
+    for r in updates:
+        by_name.setdefault(r.get("name"), []).append(r)
+
+    used: set[int] = set()
+    merged = []
+    for r in results:
+        if r.get("rashut"):
+            new = by_rashut.get(r["rashut"])
+        else:
+            new = next((u for u in by_name.get(r.get("name"), []) if id(u) not in used), None)
+        if new is not None and id(new) not in used:
+            used.add(id(new))
+            merged.append(new)
+        else:
+            merged.append(r)
+    merged += [u for u in updates if id(u) not in used]
+
+    summary = {status: sum(1 for r in merged if r.get("status") == status) for status in ("clean", "fine", "failed")}
+    return merged, build_fines(merged, summary)
+
+
+def build_scan_record(
+    ip: str,
+    id_number: str,
+    car_number: str,
+    results: list[dict],
+    summary: dict,
+    user_agent: str = "",
+    latitude: float | None = None,
+    longitude: float | None = None,
+    aborted: bool = False,
+    timings: dict | None = None,
+) -> dict:
+    """vehicle / user_info / fines / check_metadata for a new scan (no id yet)."""
+    location = None
+    if latitude is not None and longitude is not None:
+        location = {"latitude": latitude, "longitude": longitude}
+
+    check_metadata = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "ip": ip or "",
+        "platform": parse_platform(user_agent),
+        "user_agent": user_agent,
+        "location": location,
+        "raw_results": results,
+    }
+    if aborted:
+        check_metadata["aborted"] = True
+    if timings:
+        check_metadata["timings"] = timings
+
+    return {
+        "vehicle": {"car_number": car_number.strip()},
+        "user_info": {"id_number": id_number.strip()},
+        "fines": build_fines(results, summary),
+        "check_metadata": check_metadata,
+    }
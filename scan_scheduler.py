@@ -0,0 +1,125 @@
+"""
+Fair scan scheduler — hands out upstream check slots round-robin across scans.
+
+A plain semaphore serves waiters FIFO, so a scan that queued ~120 checks ahead
+of you delays your first result until its whole fan-out has started. Here each
+scan (the "owner") gets its own queue, and freed slots rotate between owners:
+one check from scan A, one from scan B, one from A, ... Time-to-first-result
+stays flat as concurrent scans grow.
+
+Owners with a higher priority are always served before lower ones; within a
+priority level the rotation is round-robin.
+
+    scheduler = FairScheduler(concurrency=200)
+    async with scheduler.slot(scan, priority=0):
+        ...
+
+The per-owner queues and their rotation live in WaiterRotation, which the
+rate limiter uses the same way to hand out its tokens.
+"""
+
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+
+
+class WaiterRotation:
+    """Waiting futures queued per owner, handed out round-robin; higher priorities first."""
+
+    def __init__(self):
+        self._queues: dict[object, deque] = {}  # owner -> waiting futures
+        self._rotation: dict[int, deque] = {}  # priority -> owners with waiters, in turn order
+
+    def __bool__(self) -> bool:
+        return bool(self._rotation)
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for q in self._queues.values() for f in q if not f.done())
+
+    @property
+    def owners(self) -> int:
+        return len(self._queues)
+
+    def add(self, owner: object, priority: int, fut: asyncio.Future) -> None:
+        queue = self._queues.get(owner)
+        if queue is None:
+            queue = self._queues[owner] = deque()
+            self._rotation.setdefault(priority, deque()).append(owner)
+        queue.append(fut)
+
+    def pop(self) -> asyncio.Future | None:
+        """The next waiter in turn (skipping cancelled ones), or None."""
+        for priority in sorted(self._rotation, reverse=True):
+            rotation = self._rotation[priority]
+            while rotation:
+                owner = rotation.popleft()
+                queue = self._queues[owner]
+                while queue and queue[0].done():
+                    queue.popleft()
+                if not queue:
+                    del self._queues[owner]
+                    continue
+                fut = queue.popleft()
+                if queue:
+                    rotation.append(owner)  # back of the line for its next turn
+                else:
+                    del self._queues[owner]
+                if not rotation:
+                    del self._rotation[priority]
+                return fut
+            del self._rotation[priority]
+        return None
+
+
+class FairScheduler:
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.active = 0
+        self._waiters = WaiterRotation()
+
+    @property
+    def queued(self) -> int:
+        return self._waiters.queued
+
+    async def acquire(self, owner: object, priority: int = 0) -> None:
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.add(owner, priority, fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # Got the slot just as we were cancelled — hand it on
+                self.release()
+            else:
+                fut.cancel()  # skipped when its turn comes
+            raise
+
+    def release(self) -> None:
+        self.active -= 1
+        while self.active < self.concurrency:
+            fut = self._waiters.pop()
+            if fut is None:
+                return
+            self.active += 1
+            fut.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, owner: object, priority: int = 0):
+        await self.acquire(owner, priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def snapshot(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "active": self.active,
+            "queued": self.queued,
+            "queued_scans": self._waiters.owners,
+        }
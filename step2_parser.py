@@ -0,0 +1,185 @@
+"""
+step2.aspx parser — pulls the fines table out of a step2 page.
+
+Each fine row looks like (columns in order):
+
+    <tr class="tableDiv data">
+      <input type="checkbox" data-price="250" name="<ReportC>">  <label>1001</label>
+      <div class="cell">01/02/2024</div>   <div class="cell">10:30</div>
+      <div class="cell w4 nomobile">location</div>
+      <div class="cell w4 nomobile"><span class="price">250.00</span></div>
+      <div class="cell w4 nomobile">comments</div>
+      <a data-class="<ReportC>">...</a>
+    </tr>
+
+parse_step2() walks the lxml tree once per row and only looks at the elements
+above. parse_step2_soup() is the original BeautifulSoup implementation; it is
+the reference the fast parser must match (bench/bench_step2.py checks that on
+saved pages) and the fallback when lxml is not installed.
+
+On the site the amount cell carries the same "cell w4 nomobile" classes as the
+location and comments cells, so it sits between them as a second w4 cell.
+Both parsers skip it when looking for comments. The original parser did not,
+and reported the amount ("250.00 ₪") as the comments.
+
+Both return (fines, total_amount). A fine may carry an internal "_report_c"
+key — the ReportC needed to look up its images.
+"""
+
+import re
+
+from bs4 import BeautifulSoup
+
+try:
+    from lxml import etree
+except ImportError:  # lxml is optional: without it the BeautifulSoup parser is used
+    etree = None
+
+_DATE_RE = re.compile(r"\d{2}/\d{2}/\d{4}")
+_TIME_RE = re.compile(r"\d{2}:\d{2}$")
+
+if etree is not None:
+    _ROWS = etree.XPath("//tr[contains(@class, 'tableDiv') and contains(@class, 'data')]")
+    # Text like BeautifulSoup's get_text(): no comments, no <script>/<style> bodies
+    _TEXT = etree.XPath(".//text()[not(parent::script or parent::style)]")
+
+
+def _text(el) -> str:
+    return "".join(s.strip() for s in _TEXT(el))
+
+
+def _has_price_descendant(el) -> bool:
+    for d in el.iterdescendants():
+        cls = d.get("class") if isinstance(d.tag, str) else None
+        if cls and "price" in cls.split():
+            return True
+    return False
+
+
+def parse_step2(html: str):
+    """Parse the step2.aspx fines table. Returns (fines, total_amount)."""
+    if etree is None:
+        return parse_step2_soup(html)
+    try:
+        root = etree.HTML(html)
+    except ValueError:  # e.g. an XML encoding declaration in a str
+        return parse_step2_soup(html)
+    if root is None:
+        return [], 0.0
+
+    fines = []
+    total = 0.0
+    for row in _ROWS(root):
+        # One pass over the row: first label / checkbox / view link / .price, and every div.cell
+        label = checkbox = view_link = price_el = None
+        cells = []
+        for el in row.iterdescendants():
+            tag = el.tag
+            if not isinstance(tag, str):
+                continue  # comment / processing instruction
+            if tag == "label":
+                if label is None:
+                    label = el
+            elif tag == "input":
+                if checkbox is None and el.get("type") == "checkbox":
+                    checkbox = el
+            elif tag == "a":
+                if view_link is None and el.get("data-class") is not None:
+                    view_link = el
+            cls = el.get("class")
+            if cls:
+                classes = cls.split()
+                if price_el is None and "price" in classes:
+                    price_el = el
+                if tag == "div" and "cell" in classes:
+                    cells.append((el, classes))
+
+        fine = {}
+        if label is not None:
+            fine["number"] = _text(label)
+        if checkbox is not None and checkbox.get("data-price"):
+            try:
+                price = float(checkbox.get("data-price"))
+                fine["amount"] = price
+                total += price
+            except ValueError:
+                pass
+            if checkbox.get("name"):
+                fine["_report_c"] = checkbox.get("name")
+        if price_el is not None:
+            fine["price_display"] = _text(price_el)
+        if view_link is not None:
+            fine["_report_c"] = view_link.get("data-class")
+
+        for div, classes in cells:
+            text = _text(div)
+            if _DATE_RE.match(text):
+                fine["date"] = text
+            elif _TIME_RE.match(text):
+                fine["time"] = text
+            elif div.get("id") == "Street" or ("w4" in classes and "nomobile" in classes and "location" not in fine and "price" not in classes):
+                if text and "location" not in fine and not _has_price_descendant(div):
+                    fine["location"] = text
+            elif "w4" in classes and "nomobile" in classes and "location" in fine and "comments" not in fine:
+                if text and "price" not in classes and not _has_price_descendant(div):  # the amount is w4 nomobile too
+                    fine["comments"] = text
+        if fine:
+            fines.append(fine)
+    return fines, total
+
+
+def parse_step2_soup(html: str):
+    """Parse the step2.aspx fines table with BeautifulSoup. Returns (fines, total_amount).
+
+    Not byte-for-byte the baseline parser any more: comments skip the amount cell,
+    which the baseline reported as the comments.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    fines = []
+    total = 0.0
+    for row in soup.select("tr.tableDiv.data, tr[class*='tableDiv'][class*='data']"):
+        fine = {}
+        label = row.find("label")
+        if label:
+            fine["number"] = label.get_text(strip=True)
+        checkbox = row.find("input", {"type": "checkbox"})
+        if checkbox and checkbox.get("data-price"):
+            try:
+                price = float(checkbox["data-price"])
+                fine["amount"] = price
+                total += price
+            except ValueError:
+                pass
+            # Extract ReportC from checkbox name attribute
+            if checkbox.get("name"):
+                fine["_report_c"] = checkbox["name"]
+        price_el = row.find(class_="price")
+        if price_el:
+            fine["price_display"] = price_el.get_text(strip=True)
+
+        # Extract ReportC from the view link (data-class attribute)
+        view_link = row.find("a", attrs={"data-class": True})
+        if view_link:
+            fine["_report_c"] = view_link["data-class"]
+
+        # Parse all cell divs in order matching column layout:
+        # [checkbox, number, date, time, location, amount, comments, view]
+        cell_divs = row.find_all("div", class_="cell")
+        for div in cell_divs:
+            text = div.get_text(strip=True)
+            classes = div.get("class", [])
+            if _DATE_RE.match(text):
+                fine["date"] = text
+            elif _TIME_RE.match(text):
+                fine["time"] = text
+            elif div.get("id") == "Street" or ("w4" in classes and "nomobile" in classes and "location" not in fine and "price" not in classes):
+                # Location column (w4 nomobile, first occurrence)
+                if text and "location" not in fine and not div.find(class_="price"):
+                    fine["location"] = text
+            elif "w4" in classes and "nomobile" in classes and "location" in fine and "comments" not in fine:
+                # Comments column (w4 nomobile, next occurrence after location that isn't the amount)
+                if text and "price" not in classes and not div.find(class_="price"):
+                    fine["comments"] = text
+        if fine:
+            fines.append(fine)
+    return fines, total
@@ -0,0 +1,46 @@
+"""
+Storage — picks the scan log backend once, at startup.
+
+    SCAN_LOG_BACKEND=supabase   scan_logger_supabase  (production)
+    SCAN_LOG_BACKEND=sqlite     scan_logger           (local file, no network)
+    SCAN_LOG_BACKEND=memory     scan_logger_memory    (in-process, for dev / load tests)
+
+Default: supabase when SUPABASE_URL is set, otherwise sqlite.
+
+Every backend exposes the same functions and returns the record shape
+described in scan_record.py:
+    log_scan, get_logs, get_log_by_id, get_stats, save_subscriber,
+    update_scan_subscriber, update_scan_vehicle, update_scan_results, close
+"""
+
+import os
+
+from dotenv import load_dotenv
+
+# Load .env file if present (local dev only)
+load_dotenv()
+
+BACKEND = os.environ.get("SCAN_LOG_BACKEND") or ("supabase" if os.environ.get("SUPABASE_URL") else "sqlite")
+
+if BACKEND == "supabase":
+    from scan_logger_supabase import (
+        log_scan, get_logs, get_log_by_id, get_stats, save_subscriber,
+        update_scan_subscriber, update_scan_vehicle, update_scan_results, close,
+    )
+elif BACKEND == "sqlite":
+    from scan_logger import (
+        log_scan, get_logs, get_log_by_id, get_stats, save_subscriber,
+        update_scan_subscriber, update_scan_vehicle, update_scan_results, close,
+    )
+elif BACKEND == "memory":
+    from scan_logger_memory import (
+        log_scan, get_logs, get_log_by_id, get_stats, save_subscriber,
+        update_scan_subscriber, update_scan_vehicle, update_scan_results, close,
+    )
+else:
+    raise RuntimeError(f"Unknown SCAN_LOG_BACKEND {BACKEND!r} (expected supabase, sqlite or memory)")
+
+__all__ = [
+    "BACKEND", "log_scan", "get_logs", "get_log_by_id", "get_stats", "save_subscriber",
+    "update_scan_subscriber", "update_scan_vehicle", "update_scan_results", "close",
+]
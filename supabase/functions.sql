@@ -0,0 +1,56 @@
+-- ── Supabase SQL functions used by scan_logger_supabase.py ──
+-- Run once in the Supabase SQL editor (safe to re-run: everything is
+-- CREATE OR REPLACE / IF NOT EXISTS). The backend falls back to slower
+-- client-side code while a function is missing.
+
+-- Aggregate stats for /scan-stats, computed in one pass on the server.
+create or replace function scan_stats()
+returns json
+language sql
+stable
+as $$
+  select json_build_object(
+    'total_scans',      count(*),
+    'unique_cars',      count(distinct vehicle->>'car_number'),
+    'total_with_fines', count(*) filter (where coalesce((fines->>'fine_count')::numeric, 0) > 0),
+    'total_fine_items', coalesce(sum((fines->>'total_fines')::numeric), 0)::bigint
+  )
+  from scan_logs;
+$$;
+
+-- Atomic JSONB merges for /subscribe and PATCH /scan-logs/{id}/vehicle:
+-- one round trip, and concurrent patches to different keys can't overwrite
+-- each other. Return the merged value (NULL when the row doesn't exist).
+create or replace function merge_scan_user_info(scan_id bigint, patch jsonb)
+returns jsonb
+language sql
+volatile
+as $$
+  update scan_logs
+     set user_info = coalesce(user_info, '{}'::jsonb) || patch
+   where id = scan_id
+  returning user_info;
+$$;
+
+create or replace function merge_scan_vehicle(scan_id bigint, patch jsonb)
+returns jsonb
+language sql
+volatile
+as $$
+  update scan_logs
+     set vehicle = coalesce(vehicle, '{}'::jsonb) || patch
+   where id = scan_id
+  returning vehicle;
+$$;
+
+-- Scan id node for each backend process (see _new_scan_id): processes running
+-- at the same time draw distinct values, so their client-side ids can't collide.
+create sequence if not exists scan_log_node_seq;
+
+create or replace function next_scan_log_node()
+returns bigint
+language sql
+volatile
+as $$
+  select nextval('scan_log_node_seq');
+$$;
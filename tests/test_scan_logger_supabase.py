@@ -0,0 +1,162 @@
+"""
+_merge_jsonb against a fake Supabase client — the merge_scan_<column>() RPC,
+and the read-modify-write fallback while that function is missing.
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+
+import pytest
+from postgrest.exceptions import APIError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SUPABASE_URL", "https://example.supabase.co")
+os.environ.setdefault("SUPABASE_SERVICE_KEY", "test.service.key")
+
+import scan_logger_supabase  # noqa: E402
+
+
+class _Result:
+    def __init__(self, data):
+        self.data = data
+
+
+class _Query:
+    """table(...).select(col) / .update(values), then .eq("id", x).execute()."""
+
+    def __init__(self, client, table):
+        self._client = client
+        self._table = table
+        self._column = None
+        self._values = None
+        self._id = None
+
+    def select(self, column):
+        self._column = column
+        return self
+
+    def update(self, values):
+        self._values = values
+        return self
+
+    def eq(self, field, value):
+        assert field == "id"
+        self._id = value
+        return self
+
+    def execute(self):
+        row = self._client.rows.get(self._id)
+        if row is None:
+            return _Result([])
+        if self._values is not None:
+            self._client.updates.append((self._table, self._id, self._values))
+            row.update(self._values)
+            return _Result([dict(row)])
+        return _Result([{self._column: row.get(self._column)}])
+
+
+class _Call:
+    def __init__(self, fn):
+        self._fn = fn
+
+    def execute(self):
+        return _Result(self._fn())
+
+
+class FakeSupabase:
+    """Rows by id; rpc() runs merge_scan_<column>() like supabase/functions.sql,
+    or fails with the PostgREST error code rpc_error."""
+
+    def __init__(self, rows, rpc_error=None):
+        self.rows = rows
+        self.rpc_error = rpc_error
+        self.rpc_calls = []
+        self.updates = []
+
+    def rpc(self, name, params):
+        self.rpc_calls.append((name, params))
+
+        def call():
+            if self.rpc_error:
+                raise APIError({"code": self.rpc_error, "message": f"public.{name} failed"})
+            row = self.rows.get(params["scan_id"])
+            if row is None:
+                return None
+            column = name.removeprefix("merge_scan_")
+            row[column] = {**(row.get(column) or {}), **params["patch"]}
+            return row[column]
+
+        return _Call(call)
+
+    def table(self, name):
+        return _Query(self, name)
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    def install(rows, rpc_error=None):
+        client = FakeSupabase(rows, rpc_error)
+        monkeypatch.setattr(scan_logger_supabase, "_supabase", client)
+        return client
+    return install
+
+
+def test_merge_uses_rpc(fake):
+    client = fake({7: {"vehicle": {"manufacturer": "Mazda"}}})
+
+    merged = scan_logger_supabase._merge_jsonb(7, "vehicle", {"model": "3"})
+
+    assert client.rpc_calls == [("merge_scan_vehicle", {"scan_id": 7, "patch": {"model": "3"}})]
+    assert client.updates == []  # no read-modify-write
+    assert merged == {"manufacturer": "Mazda", "model": "3"}
+
+
+def test_merge_falls_back_when_rpc_missing(fake):
+    client = fake({7: {"user_info": {"email": "a@b.c"}}}, rpc_error="PGRST202")  # function not found
+
+    merged = scan_logger_supabase._merge_jsonb(7, "user_info", {"first_name": "Dana"})
+
+    assert [name for name, _ in client.rpc_calls] == ["merge_scan_user_info"]
+    assert client.updates == [("scan_logs", 7, {"user_info": {"email": "a@b.c", "first_name": "Dana"}})]
+    assert merged == {"email": "a@b.c", "first_name": "Dana"}
+
+
+def test_merge_fallback_missing_row(fake):
+    fake({}, rpc_error="PGRST202")
+
+    assert scan_logger_supabase._merge_jsonb(7, "vehicle", {"model": "3"}) is None
+
+
+def test_merge_other_errors_raise(fake):
+    client = fake({7: {"vehicle": {}}}, rpc_error="42501")  # permission denied
+
+    with pytest.raises(APIError):
+        scan_logger_supabase._merge_jsonb(7, "vehicle", {"model": "3"})
+    assert client.updates == []
+
+
+@pytest.mark.parametrize("rpc_error", [None, "PGRST202"])
+def test_merges_on_different_keys_both_survive(fake, rpc_error):
+    client = fake({7: {"vehicle": None}}, rpc_error=rpc_error)
+
+    scan_logger_supabase._merge_jsonb(7, "vehicle", {"manufacturer": "Mazda"})
+    merged = scan_logger_supabase._merge_jsonb(7, "vehicle", {"model": "3"})
+
+    assert merged == {"manufacturer": "Mazda", "model": "3"}
+    assert client.rows[7]["vehicle"] == {"manufacturer": "Mazda", "model": "3"}
+
+
+def test_scan_ids_unique_across_nodes_and_bursts(monkeypatch):
+    monkeypatch.setattr(scan_logger_supabase.time, "time", lambda: 1750000000.0)  # one frozen centisecond
+    ids = []
+    for node in (7, 8):  # two processes with different leased nodes
+        monkeypatch.setattr(scan_logger_supabase, "_id_node", node)
+        monkeypatch.setattr(scan_logger_supabase, "_id_tick", 0)
+        monkeypatch.setattr(scan_logger_supabase, "_id_seq", 0)
+        ids += [scan_logger_supabase._new_scan_id() for _ in range(100)]  # more than fit in one centisecond
+
+    assert len(set(ids)) == len(ids)
+    assert all(i < 2 ** 53 for i in ids)
+    assert {(i >> 4) & 0xFFF for i in ids} == {7, 8}  # a burst borrows time, never another node